@@ -1,48 +1,140 @@
-import rdkit.Chem as Chem
 import rdkit.Chem.rdMolDescriptors as Desc
+from rdkit.Chem import Crippen
 from rdkit import RDLogger
 import pickle
 from tqdm import tqdm
 import pandas as pd
 import numpy
 import os
+import multiprocessing as mp
+import assembly_dedup
+import compound_store
+import mol_store
 
+#Descriptors available to calculate_descriptors(), as functions of an rdkit molecule
+DESCRIPTORS = {
+    "mw": Desc.CalcExactMolWt,
+    "heavy_atoms": lambda m: m.GetNumHeavyAtoms(),
+    "bonds": lambda m: m.GetNumBonds(),
+    "rings": Desc.CalcNumRings,
+    "aromatic_rings": Desc.CalcNumAromaticRings,
+    "logp": Crippen.MolLogP,
+}
 
-def get_mw(inchi):
-    """ Finds the molecular weight for a given inchi string
+
+def mol_descriptors(m, names=tuple(DESCRIPTORS)):
+    """ Calculates several descriptors of an rdkit molecule
+
+    Args:
+        m (rdkit molecule): parsed compound (None if parsing failed)
+        names (tuple): names of descriptors to calculate (keys of DESCRIPTORS)
+
+    Returns:
+        dict: value of each descriptor (NaN if the compound could not be parsed, or
+            a descriptor fails)
+    """
+    values = dict.fromkeys(names, numpy.nan)
+    if m is None:
+        return values
+
+    for name in names:
+        try:
+            values[name] = DESCRIPTORS[name](m)
+        except:
+            pass
+
+    return values
+
+
+def calculate_descriptors(inchi, names=tuple(DESCRIPTORS)):
+    """ Loads a compound once (see mol_store.py) and calculates several descriptors from it
 
     Args:
         inchi (str): inchi string of a SureChemBL compound
+        names (tuple): names of descriptors to calculate (keys of DESCRIPTORS)
 
     Returns:
-        float: molecular weight (or NaN if rdkit failure)
+        dict: value of each descriptor (NaN if rdkit cannot parse the compound, or
+            a descriptor fails)
     """
-    try:
-        m = Chem.MolFromInchi(inchi)
-        return Desc.CalcExactMolWt(m)
-    except:
-        return numpy.nan
+    return mol_descriptors(mol_store.get_mol(inchi), names)
 
 
-def main():
+def _descriptor_batch(args):
+    """ Calculates descriptors of a batch of inchis (run in a worker) """
+    inchis, names = args
     RDLogger.DisableLog('rdApp.*')
+    return [mol_descriptors(m, names) for m in mol_store.get_mols(inchis)]
+
+
+def descriptor_table(inchis,
+                     names=tuple(DESCRIPTORS),
+                     processes=None,
+                     batch_size=1000):
+    """ Calculates descriptors of many compounds in parallel
 
-    #Test: load an assembly subset, find MWs for all cpds
-    new_df = pd.DataFrame()
-    full_df = pd.DataFrame()
+    Each distinct molecule is loaded once (see assembly_dedup.py) - from the
+    parsed-molecule store if an earlier run has parsed it (see mol_store.py) - and
+    batches of molecules are spread across a pool of worker processes.
 
+    Args:
+        inchis (list): inchi strings of SureChemBL compounds
+        names (tuple): names of descriptors to calculate (keys of DESCRIPTORS)
+        processes (int): number of worker processes (default: number of cores)
+        batch_size (int): number of molecules sent to a worker at once
+
+    Returns:
+        pandas dataframe: one column per descriptor, one row per inchi (in order)
+    """
+
+    def run(unique):
+        batches = [(unique[i:i + batch_size], names)
+                   for i in range(0, len(unique), batch_size)]
+        pool = mp.Pool(processes)
+        results = [
+            values for batch in tqdm(pool.imap(_descriptor_batch, batches),
+                                     total=len(batches)) for values in batch
+        ]
+        pool.close()
+        pool.join()
+        return results
+
+    return pd.DataFrame(assembly_dedup.run_unique(list(inchis), run),
+                        columns=list(names))
+
+
+def main():
+    RDLogger.DisableLog('rdApp.*')
+
+    #Test: load an assembly subset, find descriptors for all cpds
+    dfs = []
     for f in tqdm(os.listdir("Data/AssemblyValues/")):
         if f.startswith("assembly_values_1000_"):
             data = pickle.load(file=open("Data/AssemblyValues/" + f, "rb"))
-            df = pd.DataFrame(data)
+            dfs.append((f, pd.DataFrame(data)))
+
+    if not dfs:
+        raise FileNotFoundError(
+            "No assembly_values_1000_* files found in Data/AssemblyValues/")
 
-            df["mw"] = df["inchi"].apply(get_mw)
+    #Single concat of all files, then one parallel pass over every distinct molecule
+    df = pd.concat([df.assign(full="FULL" in f) for f, df in dfs],
+                   ignore_index=True)
+    descriptors = descriptor_table(df["inchi"].tolist())
+    df = pd.concat([df, descriptors], axis=1)
 
-            if "FULL" in f:
-                full_df = full_df.append(df)
-            else:
-                new_df = new_df.append(df)
+    #Columnar copy of every compound & descriptor (see compound_store.py), with
+    # numeric object columns (e.g. bounds hints with missing values) as numbers
+    table = df.astype({"full": int})
+    for name in table.columns[table.dtypes == object]:
+        try:
+            table[name] = pd.to_numeric(table[name])
+        except (ValueError, TypeError):
+            pass
+    compound_store.write_table(table, "Data/AssemblyValues/cpds_descriptors/")
 
+    new_df = df[~df["full"]].drop(columns="full")
+    full_df = df[df["full"]].drop(columns="full")
     new_df.to_csv("Data/AssemblyValues/newCpds_AssemblyValues.csv")
     full_df.to_csv("Data/AssemblyValues/fullCpds_AssemblyValues.csv")
 
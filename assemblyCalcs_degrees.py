@@ -1,5 +1,8 @@
-import assemblycalculator as ac
-import multiprocessing as mp
+import assembly_bounds
+import assembly_cache
+import assembly_dedup
+import assembly_cost
+import assembly_runner
 import pickle
 import pandas as pd
 from itertools import islice
@@ -23,28 +26,82 @@ def get_data(fp):
     return pd.DataFrame.from_dict(data, orient="index", columns=["Degree"])
 
 
-def sample_quantiles(df, q, n):
+def degree_strata(degrees, q, spacing="quantile"):
+    """ Assigns each compound to one of q degree strata
+
+    Quantile strata hold (roughly) equal numbers of compounds; tied degrees at a
+    boundary stay together, so heavily tied degree distributions give fewer than q
+    strata (as with pd.qcut(..., duplicates="drop")). Log strata are equally
+    spaced in log(1 + degree), for an even spread over the long tail.
+
+    Args:
+        degrees (array-like): degree of each compound
+        q (int): number of strata
+        spacing (str): "quantile" or "log"
+
+    Returns:
+        numpy array: int64 stratum (0 to at most q - 1) of each compound
+    """
+    degrees = np.asarray(degrees, dtype=np.float64)
+    if spacing == "quantile":
+        edges = np.unique(np.quantile(degrees, np.linspace(0, 1, q + 1)))
+    elif spacing == "log":
+        edges = np.expm1(np.linspace(0, np.log1p(degrees.max()), q + 1))
+    else:
+        raise ValueError("spacing must be 'quantile' or 'log'")
+
+    #Interior edges only, so the minimum and maximum fall in the outer strata
+    return np.searchsorted(edges[1:-1], degrees, side="right")
+
+
+def sample_strata(strata, n, seed=0):
+    """ Samples n compounds from every stratum, without replacement, in one pass
+
+    Compounds are sorted once by stratum + a random key in [0, 0.5), and the
+    first n of each stratum are kept - so every stratum contributes exactly n compounds (or all of
+    its compounds, if it has fewer than n).
+
+    Args:
+        strata (array-like): stratum of each compound, from degree_strata()
+        n (int): sample size from each stratum
+        seed (int): random seed
+
+    Returns:
+        numpy array: positions of the sampled compounds, grouped by stratum
+    """
+    strata = np.asarray(strata)
+    keys = np.random.default_rng(seed).random(len(strata)) / 2
+    order = np.argsort(strata + keys)
+
+    #Rank of each compound within its stratum
+    sorted_strata = strata[order]
+    starts = np.flatnonzero(np.r_[True, sorted_strata[1:] != sorted_strata[:-1]])
+    sizes = np.diff(np.r_[starts, len(order)])
+    ranks = np.arange(len(order)) - np.repeat(starts, sizes)
+
+    return order[ranks < n]
+
+
+def sample_quantiles(df, q, n, spacing="quantile", seed=0):
     """ Sample n compounds from each of q quantiles within a id/degree dataframe
 
     Args:
         df (dataframe): SureChemBL id is the index, "Degree" holds the degree of that particular id
-        q (int): number of quantiles to sample from (anything over 75 seems to break, not sure why)
+        q (int): number of quantiles to sample from
         n (int): sample size from each quantile
+        spacing (str): "quantile" for equal-count strata, "log" for log-spaced degrees
+        seed (int): random seed
 
     Returns:
-        dataframe: sampled slice of original dataframe with max q compounds per quantile
+        dataframe: sampled slice of original dataframe with n (distinct) compounds per
+            quantile, and each compound's quantile in a "quantile" column
     """
-    df["quantile"] = pd.qcut(df.Degree,
-                             q=50,
-                             duplicates="drop",
-                             labels=list(np.arange(0, 50, 1)))
+    strata = degree_strata(df["Degree"].to_numpy(), q, spacing)
+    rows = sample_strata(strata, n, seed)
 
-    out = pd.concat([
-        df[df["quantile"].eq(label)].sample(n, replace=True)
-        for label in list(np.arange(0, 50, 1))
-    ])
-    #Remove duplicate indices (if possible)
-    return out[~out.index.duplicated(keep="last")]
+    out = df.iloc[rows].copy()
+    out["quantile"] = strata[rows]
+    return out
 
 
 def calculate_statistics(inchi):
@@ -62,38 +119,66 @@ def calculate_statistics(inchi):
     try:
         #Use these (small) parameters for assembly index sampling -
         #  goal is to determine ranges, not necessarily exact values
-        mc_ai = ac.calculate_ma(inchi,
-                                240,
-                                "monte-carlo",
-                                num_frags_hist=5000,
-                                path_samples=10000)
+        mc_ai = assembly_cache.calculate_ma(inchi,
+                                            240,
+                                            "monte-carlo",
+                                            num_frags_hist=5000,
+                                            path_samples=10000)
     except:
         mc_ai = -1
 
     try:
-        frag_ai = ac.calculate_ma(inchi, 240, "fragment")
+        frag_ai = assembly_cache.calculate_ma(inchi, 240, "fragment")
     except:
         frag_ai = -1
 
     return {"mc_ai": mc_ai, "frag_ai": frag_ai, "inchi": inchi}
 
 
-def get_stats(inchis):
+def get_stats(inchis, checkpoint_fp):
     """ Wrapper for parallel assembly value computations
 
+    Progress is checkpointed to checkpoint_fp, so an interrupted run resumes
+    where it stopped; hung calculations are killed and given values of -1.
+    Each distinct molecule is calculated once (see assembly_dedup.py), and
+    compounds whose MA is fixed by cheap bounds are not calculated (see
+    assembly_bounds.py).
+
     Args:
         inchis (list): list of all inchis to calculate MA values
+        checkpoint_fp (str): filepath to the checkpoint file
 
     Returns:
         list: list of dictionaries, all continaing MC/Fragment MA values & corresponding inchi
     """
-    #Set up parallelization
-    pool = mp.Pool(64)
-
-    assembly_results = [pool.map(calculate_statistics, inchis)]
-
-    pool.close()
-    pool.join()
+    def run(remaining):
+        records = assembly_runner.run_jobs(calculate_statistics,
+                                           remaining,
+                                           checkpoint_fp,
+                                           processes=64,
+                                           time_limit=2 * (240 + 240),
+                                           cost=assembly_cost.predict_seconds,
+                                           config={
+                                               "function": "calculate_statistics",
+                                               "time_limit": 2 * (240 + 240)
+                                           })
+        return [
+            r["value"] if r["status"] == "ok" else {
+                "mc_ai": -1,
+                "frag_ai": -1,
+                "inchi": r["item"]
+            } for r in records
+        ]
+
+    assembly_results = [
+        assembly_dedup.run_unique(
+            inchis, lambda unique: assembly_bounds.run_with_prefilter(
+                unique, run, lambda inchi, ai: {
+                    "mc_ai": ai,
+                    "frag_ai": ai,
+                    "inchi": inchi
+                }))
+    ]
 
     return assembly_results
 
@@ -122,7 +207,9 @@ def main():
         "Data/AssemblyDegreeCorr/sample_TESTFULLIDS_2019-12.csv")
 
     #Calculate and save assembly results (will worry about correlation later)
-    assembly_results = get_stats(list(df_inchis["InChI"]))
+    assembly_results = get_stats(
+        list(df_inchis["InChI"]),
+        "Data/AssemblyDegreeCorr/TESTFULLIDS_assemblyValues.ckpt")
     pickle.dump(assembly_results,
                 file=open(
                     "Data/AssemblyDegreeCorr/TESTFULLIDS_assemblyValues.p",
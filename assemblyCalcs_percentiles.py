@@ -1,8 +1,36 @@
-import assemblycalculator as ac
-import multiprocessing as mp
+import assembly_bounds
+import assembly_dedup
+import assembly_cache
+import assembly_cost
+import assembly_runner
 import pickle
 import pandas as pd
 import os
+from functools import partial
+
+#Settings of the Monte Carlo and fragment methods (see calculate_assembly_MC() and
+# calculate_assembly_fragment())
+MC_SETTINGS = {
+    "method": "monte-carlo",
+    "timeout": 120,
+    "num_frags_hist": 10000,
+    "path_samples": 20000
+}
+FRAGMENT_SETTINGS = {"method": "fragment", "timeout": 300}
+
+#Default tiers of the assembly pipeline (see calculate_tiered()) - a compound
+# moves on to a tier if its MA from the previous tier is at least "min_ai"
+TIERS = [{
+    "method": "monte-carlo",
+    "timeout": 120,
+    "num_frags_hist": 10000,
+    "path_samples": 20000,
+    "min_ai": None
+}, {
+    "method": "fragment",
+    "timeout": 300,
+    "min_ai": 40
+}]
 
 
 def calculate_assembly_MC(inchi):
@@ -15,11 +43,7 @@ def calculate_assembly_MC(inchi):
     Returns:
         dict: values of month, inchi, and the assembly index
     """
-    ai = ac.calculate_ma(inchi,
-                         120,
-                         "monte-carlo",
-                         num_frags_hist=10000,
-                         path_samples=20000)
+    ai = assembly_cache.calculate_ma(inchi, **MC_SETTINGS)
     return {"inchi": inchi, "ai": ai}
 
 
@@ -33,10 +57,113 @@ def calculate_assembly_fragment(inchi):
     Returns:
         dict: values of month, inchi, and the assembly index
     """
-    ai = ac.calculate_ma(inchi, method="fragment", timeout=300)
+    ai = assembly_cache.calculate_ma(inchi, **FRAGMENT_SETTINGS)
     return {"inchi": inchi, "ai": ai}
 
 
+def calculate_tiered(inchi, tiers=TIERS):
+    """ Calculate the assembly value of an inchi string through tiers of methods
+
+    The first tier always runs. Each later tier runs only if the previous tier's MA
+    is at least its "min_ai" (e.g. the fragment method for Monte Carlo MAs >= 40),
+    and its result replaces the previous one. If a tier times out (or the
+    compound cannot be parsed), the previous tier's MA is kept. Other (uncached)
+    failures are raised, so the runner records an "error" which a rerun with
+    retry=("error",) calculates again.
+
+    Args:
+        inchi (string): inchi representation of the SureChemBL compound
+        tiers (list): tier settings - method, timeout, min_ai, and any
+            num_frags_hist/path_samples for that method
+
+    Returns:
+        dict: inchi, final MA ("ai", -1 if the first tier failed), the method it came
+            from, and the MA (or failure status) of every tier which ran
+    """
+    result = {"inchi": inchi, "ai": -1, "method": None}
+    for tier in tiers:
+        if tier["min_ai"] is not None and (result["method"] is None or
+                                           result["ai"] < tier["min_ai"]):
+            break
+        try:
+            result[tier["method"] + "_ai"] = assembly_cache.calculate_ma(
+                inchi,
+                tier["timeout"],
+                tier["method"],
+                num_frags_hist=tier.get("num_frags_hist"),
+                path_samples=tier.get("path_samples"))
+        except assembly_cache.AssemblyFailure as e:
+            result[tier["method"] + "_ai"] = e.status
+            break
+        result["ai"] = result[tier["method"] + "_ai"]
+        result["method"] = tier["method"]
+
+    return result
+
+
+def calculate_tiered_MAs(files, tiers=TIERS, budget=None, processes=64):
+    """ Runs the tiered assembly pipeline over compound files in one step
+
+    Each distinct molecule over all files is calculated once (see
+    assembly_dedup.py). Compounds whose MA is fixed by cheap bounds are answered
+    directly (method "bounds", see assembly_bounds.py). Every tier of any other
+    compound runs in the same worker task. Tasks are killed past twice the sum of
+    tier timeouts, and runs are checkpointed (see assembly_runner.run_jobs()).
+
+    Args:
+        files (list): list of all files which contain relevant data
+        tiers (list): tier settings (see calculate_tiered())
+        budget (float): total worker seconds to spend - compounds left once it is
+            used up are not calculated (rerun to continue)
+        processes (int): number of worker processes
+
+    Returns:
+        Writes a dataframe for each file, with the final MA, method used and
+        per-tier MAs of every compound (status "skipped" if never calculated)
+    """
+    time_limit = 2 * sum(tier["timeout"] for tier in tiers)
+
+    def run(remaining):
+        records = assembly_runner.run_jobs(
+            partial(calculate_tiered, tiers=tiers),
+            remaining,
+            "Data/Cpd_Data/assembly_tiered.ckpt",
+            processes=processes,
+            time_limit=time_limit,
+            budget=budget,
+            cost=assembly_cost.predict_seconds,
+            config={
+                "tiers": tiers,
+                "time_limit": time_limit
+            })
+
+        return [
+            dict(r["value"], status=r["status"], seconds=r["seconds"])
+            if r["status"] == "ok" else {
+                "inchi": r["item"],
+                "ai": -1,
+                "method": None,
+                "status": r["status"],
+                "seconds": r["seconds"]
+            } for r in records
+        ]
+
+    results = assembly_dedup.run_grouped(
+        {f: read_cpds("Data/Cpd_Data/" + f) for f in files},
+        lambda unique: assembly_bounds.run_with_prefilter(
+            unique, run, lambda inchi, ai: {
+                "inchi": inchi,
+                "ai": ai,
+                "method": "bounds",
+                "status": "ok",
+                "seconds": 0
+            }))
+
+    for f in files:
+        pickle.dump(pd.DataFrame(results[f]),
+                    file=open("Data/Cpd_Data/" + f[:-4] + "_tiered.p", "wb"))
+
+
 def read_cpds(fp):
     """ Read inchi compounds from csv files
 
@@ -84,27 +211,60 @@ def get_top_percentileFiles():
     return files
 
 
+def assembly_values(records):
+    """ Converts assembly_runner records to inchi/MA dictionaries
+
+    Compounds whose calculation failed or was killed get an MA of -1.
+
+    Args:
+        records (list): status records from assembly_runner.run_jobs()
+
+    Returns:
+        list: list of dictionaries, each containing an inchi and its MA
+    """
+    return [
+        r["value"] if r["status"] == "ok" else {
+            "inchi": r["item"],
+            "ai": -1
+        } for r in records
+    ]
+
+
 def calculate_MAs(files):
     """ Wrapper function for MA calculation
 
+    Each distinct molecule over all files is calculated once (see
+    assembly_dedup.py). Progress is checkpointed to a shared checkpoint, so an
+    interrupted run resumes where it stopped and compounds already calculated in
+    earlier runs are not repeated.
+
     Args:
         files (list): list of all files which contain relevant data
 
     Returns:
         Writes a file containing inchis linked with assembly values
     """
-    for f in files:
-        cpds = read_cpds("Data/Cpd_Data/" + f)
-
-        #Set up parallelization - a bit of overhead for setting it up, but that's fine
-        pool = mp.Pool(64)
+    #Calculate assembly values using MC method (killing hung calculations),
+    # skipping compounds whose MA is fixed by cheap bounds
+    assemblies = assembly_dedup.run_grouped(
+        {f: read_cpds("Data/Cpd_Data/" + f) for f in files},
+        lambda unique: assembly_bounds.run_with_prefilter(
+            unique, lambda remaining: assembly_values(
+                assembly_runner.run_jobs(calculate_assembly_MC,
+                                         remaining,
+                                         "Data/Cpd_Data/assembly_MC.ckpt",
+                                         processes=64,
+                                         time_limit=2 * 120,
+                                         cost=assembly_cost.predict_seconds,
+                                         config=dict(MC_SETTINGS,
+                                                     time_limit=2 * 120))),
+            lambda inchi, ai: {
+                "inchi": inchi,
+                "ai": ai
+            }))
 
-        #Calculate assembly values using MC method
-        assemblies = pool.map(calculate_assembly_MC, cpds)
-
-        pool.close()
-
-        pickle.dump(assemblies,
+    for f in files:
+        pickle.dump(assemblies[f],
                     file=open("Data/Cpd_Data/" + f[:-4] + "_assembly.p", "wb"))
 
 
@@ -126,9 +286,16 @@ def calculate_largeMAs(f):
     print(large_MA_cpds)
     print()
 
-    pool = mp.Pool(64)
-    assemblies = pool.map(calculate_assembly_fragment, large_MA_cpds)
-    pool.close
+    assemblies = assembly_dedup.run_unique(
+        large_MA_cpds, lambda unique: assembly_values(
+            assembly_runner.run_jobs(calculate_assembly_fragment,
+                                     unique,
+                                     "Data/Cpd_Data/assembly_fragment.ckpt",
+                                     processes=64,
+                                     time_limit=2 * 300,
+                                     cost=assembly_cost.predict_seconds,
+                                     config=dict(FRAGMENT_SETTINGS,
+                                                 time_limit=2 * 300))))
     pickle.dump(assemblies,
                 file=open("Data/Cpd_Data/" + f[:-2] + "_large.p", "wb"))
 
@@ -152,6 +319,9 @@ def main():
     # files = get_top_percentileFiles()
     # calculate_MAs(files)
 
+    # ### TOP ATTACHMENT VALUES - Monte Carlo & fragment MAs in one run ###
+    # calculate_tiered_MAs(get_top_percentileFiles(), budget=64 * 4 * 3600)
+
     for pair in [(1980, 1984), (1985, 1989), (1990, 1994), (1995, 1999),
                  (2000, 2004), (2005, 2009), (2010, 2014), (2015, 2019)]:
         f = "ids_above99_99percentile" + str(pair[0]) + "_" + str(
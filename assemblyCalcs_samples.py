@@ -1,4 +1,6 @@
-import assemblycalculator as ac
+import assembly_bounds
+import assembly_cache
+import assembly_dedup
 import multiprocessing as mp
 import pickle
 import numpy as np
@@ -36,46 +38,112 @@ def calculate_assembly(month, inchi):
     Returns:
         dict: values of month, inchi, and the assembly index
     """
-    ai = ac.calculate_ma(inchi,
-                         60,
-                         "monte-carlo",
-                         num_frags_hist=5000,
-                         path_samples=10000)
+    ai = assembly_cache.calculate_ma(inchi,
+                                     60,
+                                     "monte-carlo",
+                                     num_frags_hist=5000,
+                                     path_samples=10000)
     return {"month": month, "inchi": inchi, "ai": ai}
 
 
-def main():
-
-    #Read in sampled compounds (updated for full 1000 compounds)
-    #NOTE: add "_NEW" for new compounds found in each year (remove for all compounds)
-    cpds = pickle.load(file=open("Data/sample_inchi_1000.p", "rb"))
+def _calculate_task(task):
+    """ Unpacks a (month, inchi) task for calculate_assembly() (run in a worker)
 
-    for year in np.arange(1987, 2020, 1):
-        #Set up parallelization - a bit of overhead for setting it up, but that's fine
-        pool = mp.Pool(64)
+    A timed out or failed calculation gives an assembly value of None, with the
+    failure status (see assembly_cache.AssemblyFailure, or "error" for uncached
+    failures), instead of stopping the run.
+    """
+    month, inchi = task
+    try:
+        return calculate_assembly(month, inchi)
+    except assembly_cache.AssemblyFailure as e:
+        return {"month": month, "inchi": inchi, "ai": None, "status": e.status}
+    except Exception:
+        return {"month": month, "inchi": inchi, "ai": None, "status": "error"}
+
+
+def run_assemblies(cpds, years, fp, processes=64, chunksize=None):
+    """ Calculates assembly values of all sampled compounds in one long-lived pool
+
+    Tasks from every year are streamed into the pool and collected as they
+    complete (in any order), so all workers stay busy. Each distinct molecule is
+    calculated once, and its result is given to every month which sampled it (see
+    assembly_dedup.py). Compounds whose MA is fixed by cheap bounds are answered
+    without the pool (see assembly_bounds.py). Each year is saved as soon as its
+    last compound finishes, with results sorted by month. Compounds whose
+    calculation timed out or failed are saved with "ai" None and their "status".
 
-        #Build months in a specific year
-        months = build_month_increments(year, year)
+    Args:
+        cpds (dict): sampled inchis of each month, {"YYYY-MM": [inchis]}
+        years (list): years to calculate
+        fp (string): output filepath prefix - each year is saved to fp + YEAR + ".p"
+        processes (int): number of worker processes
+        chunksize (int): tasks sent to a worker at once (default: small chunks, so
+            long calculations stay balanced across workers)
+    """
+    tasks = []
+    remaining = {}
+    for year in years:
+        year_tasks = [(month, cpd)
+                      for month in build_month_increments(year, year)
+                      for cpd in cpds.get(month, [])]
+        tasks += year_tasks
+        remaining[str(year)] = len(year_tasks)
+
+    results = {year: [] for year in remaining}
+    exact, _ = assembly_bounds.prefilter([cpd for _, cpd in tasks])
+    for month, cpd in tasks:
+        if cpd in exact:
+            results[month[:4]].append({
+                "month": month,
+                "inchi": cpd,
+                "ai": exact[cpd]
+            })
+            remaining[month[:4]] -= 1
+    tasks = [(month, cpd) for month, cpd in tasks if cpd not in exact]
+
+    for year in [year for year, count in remaining.items() if count == 0]:
+        pickle.dump(sorted(results.pop(year), key=lambda a: a["month"]),
+                    file=open(fp + year + ".p", "wb"))
+
+    #Group repeated molecules (across all months) into a single task
+    waiting = {}
+    for month, cpd in tasks:
+        waiting.setdefault(assembly_dedup.inchi_key(cpd), []).append((month, cpd))
+    print("-- Distinct molecules:", len(waiting), "of", len(tasks), "--")
+    unique_tasks = [group[0] for group in waiting.values()]
+
+    if chunksize is None:
+        chunksize = max(1, min(16, len(unique_tasks) // (processes * 32)))
+
+    pool = mp.Pool(processes)
+    for assembly in pool.imap_unordered(_calculate_task, unique_tasks,
+                                        chunksize):
+        for month, cpd in waiting.pop(assembly_dedup.inchi_key(
+                assembly["inchi"])):
+            year = month[:4]
+            results[year].append(dict(assembly, month=month, inchi=cpd))
+            remaining[year] -= 1
+
+            #Save each year as soon as it is complete
+            if remaining[year] == 0:
+                pickle.dump(sorted(results.pop(year), key=lambda a: a["month"]),
+                            file=open(fp + year + ".p", "wb"))
+
+    pool.close()
+    pool.join()
 
-        date_cpd_sets = []
-        for key, value in cpds.items():
-            if key in months:
-                for cpd in value:
-                    date_cpd_sets.append((key, cpd))
 
-        #Calculate assembly values for all inchis, save in a list holding dictionaries
-        assemblies = [
-            pool.apply(calculate_assembly, args=(s[0], s[1]))
-            for s in date_cpd_sets
-        ]
+def main():
 
-        pool.close()
-        pool.join()
+    #Read in sampled compounds (updated for full 1000 compounds)
+    #NOTE: add "_NEW" for new compounds found in each year (remove for all compounds)
+    cpds = pickle.load(file=open("Data/sample_inchi_1000.p", "rb"))
 
-        #NOTE: include '_FULL_' when sampling all compounds
-        pickle.dump(assemblies,
-                    file=open("Data/assembly_values_1000_FULL_" + str(year) + ".p",
-                              "wb"))
+    #Calculate assembly values for all inchis, saved as a list of dictionaries per year
+    #NOTE: include '_FULL_' when sampling all compounds
+    run_assemblies(cpds, np.arange(1987, 2020, 1),
+                   "Data/assembly_values_1000_FULL_")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,96 @@
+""" Cheap bounds on the assembly index, used to skip calculate_ma() calls
+
+The assembly index (MA) of a connected molecule with B bonds is at most B - 1
+(add one bond at a time), and at least ceil(log2(B)) (each joining step at most
+doubles the largest object). For molecules with up to three bonds the two bounds
+meet, so the MA is known without calling the assembly calculator. Bond counts are
+read from the InChI string (see assembly_cost.inchi_descriptors()), so no RDKit
+parsing is needed either.
+
+Disconnected compounds (salts, mixtures) are never answered here, as the
+calculator's treatment of multiple components may differ.
+
+"""
+
+import math
+import assembly_cost
+
+
+def bounds(inchi):
+    """ Lower and upper bounds on the MA of a compound
+
+    Args:
+        inchi (string): compound inchi descriptor
+
+    Returns:
+        tuple: (lower, upper) bounds on the MA - (0, None) if the compound is
+            disconnected or cannot be read
+    """
+    layers = str(inchi).split("/")
+    connections = [layer for layer in layers[2:] if layer.startswith("c")]
+    #A "." or a leading multiplier (e.g. 2ClH) in the formula layer means
+    #several components
+    if (len(layers) < 2 or "." in layers[1] or layers[1][:1].isdigit() or
+            any(";" in layer or "*" in layer for layer in connections)):
+        return 0, None
+
+    descriptors = assembly_cost.inchi_descriptors(inchi)
+    if descriptors["heavy_atoms"] == 0:
+        return 0, None
+
+    n_bonds = descriptors["bonds"]
+    if n_bonds <= 1:
+        return 0, 0
+    return math.ceil(math.log2(n_bonds)), n_bonds - 1
+
+
+def prefilter(inchis):
+    """ Answers every compound whose MA bounds coincide, and reports the calls saved
+
+    Args:
+        inchis (list): inchis to calculate
+
+    Returns:
+        tuple: (dict of inchi: exact MA for answered compounds, dict of inchi:
+            (lower, upper) bound hints for all other compounds)
+    """
+    exact = {}
+    hints = {}
+    for inchi in inchis:
+        lower, upper = bounds(inchi)
+        if lower == upper:
+            exact[inchi] = lower
+        else:
+            hints[inchi] = (lower, upper)
+
+    answered = sum(inchi in exact for inchi in inchis)
+    print("-- Prefilter answered", answered, "of", len(inchis), "compounds (",
+          round(100 * answered / max(1, len(inchis)), 2), "% of calls saved) --")
+
+    return exact, hints
+
+
+def run_with_prefilter(inchis, run, answer):
+    """ Runs a calculation only for compounds the prefilter cannot answer
+
+    Args:
+        inchis (list): inchis to calculate
+        run (function): calculates a list of inchis, returning one result
+            dictionary per inchi (in order)
+        answer (function): builds the result dictionary of an answered compound,
+            from its inchi and exact MA
+
+    Returns:
+        list: result dictionary of every inchi, in order - calculated results also
+            hold the bounds hints as "ai_lower" and "ai_upper"
+    """
+    exact, hints = prefilter(inchis)
+    remaining = [inchi for inchi in inchis if inchi not in exact]
+    results = dict(zip(remaining, run(remaining)))
+
+    return [
+        answer(inchi, exact[inchi]) if inchi in exact else dict(
+            results[inchi],
+            ai_lower=hints[inchi][0],
+            ai_upper=hints[inchi][1]) for inchi in inchis
+    ]
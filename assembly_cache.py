@@ -0,0 +1,170 @@
+""" Persistent cache of assembly index (MA) calculations
+
+ac.calculate_ma() takes up to several minutes per molecule, and the same InChIs
+are sampled again across assemblyCalcs_samples, assemblyCalcs_degrees and
+assemblyCalcs_percentiles runs. calculate_ma() here is a drop-in replacement which
+stores every deterministic result - MAs, timeouts and unparseable compounds - in
+a local sqlite database, keyed by InChIKey, method and parameters (timeout,
+num_frags_hist, path_samples). Repeated molecule/setting pairs are then served
+from disk. Any other exception (a calculator bug, MemoryError, a locked
+database...) is raised uncached, so a rerun calculates the molecule again.
+
+Compounds already recorded as unparseable in mol_store.py (e.g. by the descriptor
+stage) are recorded as such without calling the calculator - the store is only
+read here, so no extra parse is added to uncached calculations.
+
+The database uses write-ahead logging, so worker processes of a multiprocessing
+pool can read and write it concurrently (each process opens its own connection).
+
+"""
+
+import os
+import sqlite3
+import assemblycalculator as ac
+import mol_store
+from assembly_dedup import inchi_key
+
+#Default cache location (relative to the working directory, as with Data/)
+DEFAULT_CACHE = "Data/assembly_cache.sqlite"
+
+#Open connection of this process, for each cache filepath
+_connections = {}
+
+
+class AssemblyFailure(Exception):
+    """ A (cached) assembly calculation which timed out, or of an unparseable compound """
+
+    def __init__(self, status, message):
+        super().__init__(status + ": " + message)
+        self.status = status
+        self.message = message
+
+
+def connect(fp=DEFAULT_CACHE):
+    """ Opens (once per process) the cache database, creating it if needed
+
+    Args:
+        fp (string): filepath to the sqlite cache
+
+    Returns:
+        sqlite3 connection
+    """
+    key = (os.getpid(), fp)
+    if key not in _connections:
+        os.makedirs(os.path.dirname(fp) or ".", exist_ok=True)
+        conn = sqlite3.connect(fp, timeout=300, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS assembly (
+                            inchikey TEXT NOT NULL,
+                            method TEXT NOT NULL,
+                            timeout REAL NOT NULL,
+                            num_frags_hist INTEGER NOT NULL,
+                            path_samples INTEGER NOT NULL,
+                            status TEXT NOT NULL,
+                            ai REAL,
+                            message TEXT,
+                            inchi TEXT,
+                            PRIMARY KEY (inchikey, method, timeout,
+                                         num_frags_hist, path_samples))""")
+        _connections[key] = conn
+    return _connections[key]
+
+
+def _params(method, timeout, num_frags_hist, path_samples):
+    #Unused parameters are stored as -1 (NULLs are never equal in a primary key)
+    return (method, float(timeout), -1 if num_frags_hist is None else
+            int(num_frags_hist), -1 if path_samples is None else int(path_samples))
+
+
+def lookup(inchi,
+           timeout,
+           method,
+           num_frags_hist=None,
+           path_samples=None,
+           cache_fp=DEFAULT_CACHE):
+    """ Finds a cached result without calculating anything
+
+    Returns:
+        tuple: (status, ai, message), or None if this molecule/setting pair is not cached
+    """
+    #"error" rows (any exception, cached by earlier versions) are recalculated
+    return connect(cache_fp).execute(
+        """SELECT status, ai, message FROM assembly WHERE inchikey=? AND
+           method=? AND timeout=? AND num_frags_hist=? AND path_samples=? AND
+           status != 'error'""",
+        (inchi_key(inchi),) +
+        _params(method, timeout, num_frags_hist, path_samples)).fetchone()
+
+
+def store(inchi,
+          timeout,
+          method,
+          status,
+          ai=None,
+          message="",
+          num_frags_hist=None,
+          path_samples=None,
+          cache_fp=DEFAULT_CACHE):
+    """ Saves a result ("ok", "timeout" or "unparseable") for a molecule/setting pair """
+    connect(cache_fp).execute(
+        "INSERT OR REPLACE INTO assembly VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (inchi_key(inchi),) +
+        _params(method, timeout, num_frags_hist, path_samples) +
+        (status, ai, message, inchi))
+
+
+def calculate_ma(inchi,
+                 timeout,
+                 method,
+                 num_frags_hist=None,
+                 path_samples=None,
+                 cache_fp=DEFAULT_CACHE):
+    """ Cached version of ac.calculate_ma()
+
+    Args:
+        inchi (string): compound inchi descriptor
+        timeout (float): calculation timeout in seconds
+        method (string): "monte-carlo" or "fragment"
+        num_frags_hist (int): monte-carlo fragment histogram size
+        path_samples (int): monte-carlo path samples
+        cache_fp (string): filepath to the sqlite cache
+
+    Returns:
+        assembly index of the compound
+
+    Raises:
+        AssemblyFailure: if the calculation timed out or the compound cannot be
+            parsed (now or in a previous run with the same settings)
+        Exception: any other calculator failure, which is not cached
+    """
+    cached = lookup(inchi, timeout, method, num_frags_hist, path_samples,
+                    cache_fp)
+    if cached is None:
+        kwargs = {}
+        if num_frags_hist is not None:
+            kwargs["num_frags_hist"] = num_frags_hist
+        if path_samples is not None:
+            kwargs["path_samples"] = path_samples
+
+        if mol_store.is_unparseable(inchi):
+            cached = ("unparseable", None, "RDKit cannot parse InChI")
+        else:
+            try:
+                cached = ("ok", ac.calculate_ma(inchi, timeout, method,
+                                                **kwargs), "")
+            except Exception as e:
+                if not (isinstance(e, TimeoutError) or
+                        "timeout" in type(e).__name__.lower()):
+                    raise
+                cached = ("timeout", None, repr(e))
+
+        store(inchi, timeout, method, cached[0], cached[1], cached[2],
+              num_frags_hist, path_samples, cache_fp)
+
+    status, ai, message = cached
+    if status != "ok":
+        raise AssemblyFailure(status, message)
+    if ai is not None and float(ai).is_integer():
+        return int(ai)
+    return ai
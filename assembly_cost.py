@@ -0,0 +1,123 @@
+""" Cost model for assembly index calculations
+
+Assembly runtimes grow roughly exponentially with molecule size, so a handful of
+large molecules dominate a run. predict_seconds() estimates the runtime of a
+compound from cheap descriptors read straight from its InChI string (no RDKit
+parsing): heavy atoms from the formula layer, bonds from the connection layer,
+and rings from the two (bonds - atoms + components). assembly_runner.run_jobs()
+uses it to start the most expensive compounds first.
+
+The model is log-linear, log(seconds) = intercept + coefficients . descriptors,
+and calibrate() refits it from the predicted/actual times recorded by a run.
+
+"""
+
+import re
+import numpy as np
+import pandas as pd
+
+#Descriptor order used by the model
+DESCRIPTORS = ["heavy_atoms", "bonds", "rings"]
+
+#Default model coefficients: (intercept, heavy atoms, bonds, rings)
+DEFAULT_COEFFICIENTS = (-4.0, 0.12, 0.02, 0.3)
+
+_ELEMENT = re.compile(r"([A-Z][a-z]?)(\d*)")
+_CONNECTION = re.compile(r"(\d+)|([-(),;*])")
+
+
+def inchi_descriptors(inchi):
+    """ Reads heavy atom, bond and ring counts from an InChI string
+
+    Repeated components (e.g. "2Na" or "2*1-2") are counted once.
+
+    Args:
+        inchi (string): compound inchi descriptor
+
+    Returns:
+        dict: heavy_atoms, bonds and rings of the compound (zeros if unparseable)
+    """
+    layers = str(inchi).split("/")
+    if len(layers) < 2:
+        return dict.fromkeys(DESCRIPTORS, 0)
+
+    #Formula layer, e.g. "C6H6O" or "C2H4O2.Na"
+    components = layers[1].split(".")
+    heavy_atoms = 0
+    for component in components:
+        for element, count in _ELEMENT.findall(component.lstrip("0123456789")):
+            if element != "H":
+                heavy_atoms += int(count) if count else 1
+
+    #Connection layer, e.g. "c1-2-4-6-5-3-1" - every atom number which follows
+    # a bond or branch symbol is one bond
+    bonds = 0
+    connections = [layer for layer in layers[2:] if layer.startswith("c")]
+    if connections:
+        previous = None
+        for number, symbol in _CONNECTION.findall(connections[0][1:]):
+            if number and previous in ("-", "(", ")", ","):
+                bonds += 1
+            previous = symbol or number and "n"
+
+    return {
+        "heavy_atoms": heavy_atoms,
+        "bonds": bonds,
+        "rings": max(0, bonds - heavy_atoms + len(components))
+    }
+
+
+def predict_seconds(inchi, coefficients=DEFAULT_COEFFICIENTS):
+    """ Predicted assembly calculation time of a compound
+
+    Args:
+        inchi (string): compound inchi descriptor
+        coefficients (tuple): model (intercept, heavy atoms, bonds, rings)
+
+    Returns:
+        float: predicted seconds
+    """
+    descriptors = inchi_descriptors(inchi)
+    log_seconds = coefficients[0] + sum(
+        c * descriptors[name] for c, name in zip(coefficients[1:], DESCRIPTORS))
+    return float(np.exp(min(log_seconds, 50)))
+
+
+def timing_table(records):
+    """ Predicted vs. actual time of every task from a run
+
+    Args:
+        records (list): status records from assembly_runner.run_jobs() with a cost
+            model (each has "predicted" and "seconds")
+
+    Returns:
+        pandas dataframe: inchi, status, descriptors, predicted and actual seconds
+    """
+    return pd.DataFrame([
+        dict(inchi_descriptors(r["item"]),
+             inchi=r["item"],
+             status=r["status"],
+             predicted=r.get("predicted", np.nan),
+             actual=r["seconds"]) for r in records
+    ])
+
+
+def calibrate(records):
+    """ Refits the model coefficients to the actual times of completed tasks
+
+    Killed tasks are left out, since their actual time is only a lower bound.
+
+    Args:
+        records (list): status records from assembly_runner.run_jobs()
+
+    Returns:
+        tuple: new model coefficients (intercept, heavy atoms, bonds, rings)
+    """
+    df = timing_table(records)
+    df = df[(df["status"] == "ok") & (df["actual"] > 0)]
+
+    X = np.column_stack([np.ones(len(df))] +
+                        [df[name].to_numpy(dtype=float) for name in DESCRIPTORS])
+    coefficients, _, _, _ = np.linalg.lstsq(X, np.log(df["actual"]), rcond=None)
+
+    return tuple(coefficients)
@@ -0,0 +1,80 @@
+""" Deduplication of compounds ahead of assembly and descriptor jobs
+
+The same compound shows up in several months of sample_inchi_1000*.p, several
+ids_above99_99percentile*/ids_change_* files, and the degree-quantile sample.
+run_unique() and run_grouped() canonicalize inchis to InChIKeys, run a job once
+per distinct molecule, and fan the results back out to every input that
+referenced it.
+
+"""
+
+from rdkit import Chem
+from rdkit import RDLogger
+
+RDLogger.DisableLog("rdApp.*")
+
+
+def inchi_key(inchi):
+    """ Canonical InChIKey of an InChI (the InChI itself if rdkit cannot convert it)
+
+    Args:
+        inchi (string): compound inchi descriptor
+
+    Returns:
+        string: canonical key for the compound
+    """
+    try:
+        key = Chem.InchiToInchiKey(inchi)
+    except Exception:
+        key = None
+    return key or inchi
+
+
+def _fan_out(result, inchi):
+    #Result dictionaries name the inchi they were calculated for - use the input's own
+    if isinstance(result, dict) and "inchi" in result:
+        return dict(result, inchi=inchi)
+    return result
+
+
+def run_unique(inchis, run):
+    """ Runs a job once per distinct molecule, returning a result for every input
+
+    Args:
+        inchis (list): inchis, possibly with repeated molecules
+        run (function): job over a list of distinct inchis, returning one result per
+            inchi (in order)
+
+    Returns:
+        list: result of every input inchi, in order
+    """
+    keys = [inchi_key(inchi) for inchi in inchis]
+    unique = {}
+    for key, inchi in zip(keys, inchis):
+        unique.setdefault(key, inchi)
+    print("-- Distinct molecules:", len(unique), "of", len(inchis), "--")
+
+    results = dict(zip(unique.keys(), run(list(unique.values()))))
+
+    return [_fan_out(results[key], inchi) for key, inchi in zip(keys, inchis)]
+
+
+def run_grouped(groups, run):
+    """ Runs a job once per distinct molecule over several groups of inchis
+
+    Args:
+        groups (dict): lists of inchis, e.g. by file or month
+        run (function): job over a list of distinct inchis, returning one result per
+            inchi (in order)
+
+    Returns:
+        dict: list of results for each group, in the order of that group's inchis
+    """
+    labels = [label for label, inchis in groups.items() for _ in inchis]
+    inchis = [inchi for group in groups.values() for inchi in group]
+
+    grouped = {label: [] for label in groups}
+    for label, result in zip(labels, run_unique(inchis, run)):
+        grouped[label].append(result)
+
+    return grouped
@@ -0,0 +1,271 @@
+""" Checkpointed, resumable job runner for long assembly calculations
+
+pool.map() only returns once every task has finished, so a SLURM time limit (see
+run.sh) or a single hung RDKit call loses a whole run. run_jobs() runs tasks on
+its own worker processes instead:
+    - each worker gets one task at a time, so a worker which runs past the wall
+      clock limit is killed and replaced without affecting the others
+    - completed results are checkpointed to disk at intervals (and at the end)
+    - a rerun with the same checkpoint file skips tasks which are already done
+      (tasks which were killed at the time limit are run again, by default) -
+      the checkpoint stores the run's settings, and a rerun with different
+      settings is refused rather than reusing stale records
+    - an optional budget of total worker seconds stops new tasks from starting
+      once it is spent (a rerun continues with the tasks which were skipped)
+    - with a cost model (e.g. assembly_cost.predict_seconds), tasks start in
+      decreasing order of predicted cost, so the longest calculations do not
+      end up as stragglers while the other workers sit idle
+
+Every task gets a status record:
+    {"item": task item, "status": "ok" | "error" | "killed" | "skipped", "value": result
+     (None unless ok), "message": error message, "seconds": wall time,
+     "predicted": predicted seconds (with a cost model)}
+
+"""
+
+import os
+import pickle
+import time
+import traceback
+import multiprocessing as mp
+from multiprocessing.connection import wait
+
+
+def _work(function, conn):
+    """ Worker loop: receives (index, item) tasks, sends back (index, status, value, message) """
+    while True:
+        task = conn.recv()
+        if task is None:
+            return
+        index, item = task
+        try:
+            conn.send((index, "ok", function(item), ""))
+        except Exception:
+            conn.send((index, "error", None, traceback.format_exc(limit=3)))
+
+
+class _Worker:
+    """ A worker process with its own pipe, running at most one task """
+
+    def __init__(self, function, ctx):
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=_work,
+                                   args=(function, child),
+                                   daemon=True)
+        self.process.start()
+        child.close()
+        self.index = None
+        self.started = None
+
+    def submit(self, index, item):
+        self.index = index
+        self.started = time.time()
+        self.conn.send((index, item))
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.kill()
+
+
+def load_checkpoint(fp, config=None):
+    """ Reads completed task records from a checkpoint ({} if there is none)
+
+    Args:
+        fp (string): filepath to the checkpoint pickle
+        config (object): settings of the run (e.g. method, timeouts) - must match
+            the settings the checkpoint was written with
+
+    Returns:
+        dict: {task key: status record}
+    """
+    if not os.path.isfile(fp):
+        return {}
+    checkpoint = pickle.load(file=open(fp, "rb"))
+    if checkpoint["config"] != config:
+        raise ValueError("Checkpoint " + fp + " was written with settings " +
+                         str(checkpoint["config"]) + ", not " + str(config) +
+                         " - use a new checkpoint file")
+    return checkpoint["records"]
+
+
+def save_checkpoint(records, fp, config=None):
+    """ Writes task records (and run settings) to a checkpoint atomically (a
+    partial file is never read) """
+    os.makedirs(os.path.dirname(fp) or ".", exist_ok=True)
+    pickle.dump({
+        "config": config,
+        "records": records
+    },
+                file=open(fp + ".tmp", "wb"))
+    os.replace(fp + ".tmp", fp)
+
+
+def run_jobs(function,
+             items,
+             checkpoint_fp,
+             processes=64,
+             time_limit=None,
+             checkpoint_seconds=300,
+             key=None,
+             budget=None,
+             cost=None,
+             retry=("killed",),
+             config=None):
+    """ Runs function over items in parallel, with checkpoints and a per-task time limit
+
+    Args:
+        function (function): function of a single item (must be picklable)
+        items (list): task items (e.g. inchis)
+        checkpoint_fp (string): filepath to the checkpoint pickle - records of
+            finished tasks are loaded from (and saved to) this file
+        processes (int): number of worker processes
+        time_limit (float): wall clock seconds after which a task's worker is killed
+            and replaced (None for no limit)
+        checkpoint_seconds (float): minimum seconds between checkpoints
+        key (function): checkpoint key of an item (default: the item itself)
+        budget (float): total worker seconds to spend - no new tasks are started
+            once it is used up, and unstarted tasks are returned as "skipped"
+            (they are not checkpointed, so a rerun runs them)
+        cost (function): predicted seconds of an item - tasks are started longest
+            first, and predicted vs. actual times are recorded and summarized
+        retry (tuple): statuses of checkpointed records which are run again (e.g.
+            ("killed", "error") after raising the time limit or fixing a bug)
+        config (object): settings of the run (e.g. method, timeouts, time_limit),
+            stored in the checkpoint - resuming with different settings raises a
+            ValueError
+
+    Returns:
+        list: status record of every item, in the order of items
+    """
+    key = key or (lambda item: item)
+    records = load_checkpoint(checkpoint_fp, config)
+    todo = [
+        i for i, item in enumerate(items)
+        if key(item) not in records or records[key(item)]["status"] in retry
+    ]
+    print("-- Tasks:", len(items), "- already done:",
+          len(items) - len(todo), "--")
+
+    ctx = mp.get_context()
+    workers = []
+    predicted = {}
+    if cost is not None:
+        predicted = {i: cost(items[i]) for i in todo}
+        todo.sort(key=lambda i: predicted[i], reverse=True)
+    pending = list(reversed(todo))
+    last_checkpoint = time.time()
+    spent = 0
+
+    def record(index, status, value, message, seconds):
+        nonlocal spent
+        spent += seconds
+        records[key(items[index])] = {
+            "item": items[index],
+            "status": status,
+            "value": value,
+            "message": message,
+            "seconds": seconds
+        }
+        if index in predicted:
+            records[key(items[index])]["predicted"] = predicted[index]
+
+    try:
+        workers = [
+            _Worker(function, ctx) for _ in range(min(processes, len(todo)))
+        ]
+        for worker in workers:
+            if pending and (budget is None or spent < budget):
+                index = pending.pop()
+                worker.submit(index, items[index])
+
+        while any(worker.index is not None for worker in workers):
+            busy = [worker for worker in workers if worker.index is not None]
+            wait_time = None
+            if time_limit is not None:
+                wait_time = max(
+                    0,
+                    min(worker.started for worker in busy) + time_limit -
+                    time.time())
+            ready = wait([worker.conn for worker in busy], wait_time)
+
+            for n, worker in enumerate(workers):
+                if worker.index is None:
+                    continue
+                seconds = time.time() - worker.started
+
+                if worker.conn in ready:
+                    try:
+                        index, status, value, message = worker.conn.recv()
+                    except EOFError:
+                        #Worker died (e.g. a crash inside RDKit); join it
+                        #before reading the exit code
+                        worker.kill()
+                        index, status, value, message = (
+                            worker.index, "error", None,
+                            "worker exited with code " +
+                            str(worker.process.exitcode))
+                        worker = workers[n] = _Worker(function, ctx)
+                    record(index, status, value, message, seconds)
+                elif time_limit is not None and seconds > time_limit:
+                    #Kill and replace a worker past the wall clock limit
+                    record(worker.index, "killed", None,
+                           "exceeded " + str(time_limit) + "s", seconds)
+                    worker.kill()
+                    worker = workers[n] = _Worker(function, ctx)
+                else:
+                    continue
+
+                worker.index = None
+                if pending and (budget is None or spent < budget):
+                    index = pending.pop()
+                    worker.submit(index, items[index])
+
+            if time.time() - last_checkpoint > checkpoint_seconds:
+                save_checkpoint(records, checkpoint_fp, config)
+                last_checkpoint = time.time()
+    finally:
+        for worker in workers:
+            if worker.index is None:
+                worker.stop()
+            else:
+                worker.kill()
+        save_checkpoint(records, checkpoint_fp, config)
+
+    skipped = {
+        "status": "skipped",
+        "value": None,
+        "message": "budget spent",
+        "seconds": 0
+    }
+    #Items still pending were never started, including retried ones whose
+    #old record is kept in the checkpoint
+    unstarted = set(pending)
+    results = [
+        dict(skipped, item=item) if i in unstarted else records[key(item)]
+        for i, item in enumerate(items)
+    ]
+    statuses = [r["status"] for r in results]
+    print("-- ok:", statuses.count("ok"), "- error:", statuses.count("error"),
+          "- killed:", statuses.count("killed"), "- skipped:",
+          statuses.count("skipped"), "--")
+    timed = [(r["predicted"], r["seconds"])
+             for r in results
+             if r["status"] == "ok" and r.get("predicted")]
+    if timed:
+        ratios = sorted(actual / pred for pred, actual in timed)
+        print("-- Predicted time:", round(sum(p for p, _ in timed)),
+              "s - actual:", round(sum(a for _, a in timed)),
+              "s - median actual/predicted:", round(ratios[len(ratios) // 2],
+                                                    2), "--")
+
+    return results
@@ -19,7 +19,10 @@ from itertools import combinations
 import calendar
 import subprocess
 import os
+import re
 from tqdm import tqdm
+import month_pipeline
+import compound_store
 
 
 def read_data(fp):
@@ -403,36 +406,118 @@ def build_month_list(start, end):
     return updates
 
 
-def build_cpd_ID_mapping(fp):
+def build_cpd_ID_mapping(fp, collapse=False):
     """ Builds a dictionary mapping SureChemBL IDs to numerical indicies,
     for ease of building an igraph network
 
+    Only the SureChEMBL_ID (and InChIKey, when collapsing) columns of the compound
+    table are read.
+
+    With collapse=True, compounds are grouped into parent nodes by the first block
+    of their InChIKey (the connectivity layer), so stereoisomers and isotopic
+    variants of a compound share an index. Compounds without an InChIKey are their
+    own parent. Every later step (replaceIds, first-month index, full network)
+    then works at parent level, merging the parents' edges and dates.
+
     Args:
         fp (string): filepath to location of compound data
+        collapse (bool): map compounds to parent indicies
 
     Returns:
-        none: does save dictionary to cp_ID_index_dict.p
+        none: does save dictionary to cp_ID_index_dict.p (or, when collapsing,
+            cpd_parent_index_dict.p and the reverse map cpd_parent_members.p -
+            see expand_parents())
     """
-    allcpds = pd.read_pickle(fp + "SureChemBL_allCpds.p")
-    unique_cpds = list(set(allcpds["SureChEMBL_ID"].tolist()))
-    print("Cpds with IDs:", len(allcpds["SureChEMBL_ID"].tolist()))
-    print("All compounds:", len(allcpds))
-    print("Unique cpds:", len(list(set(allcpds["SureChEMBL_ID"].tolist()))))
+    table = compound_store.read_table(
+        os.path.join(fp, "SureChemBL_allCpds"),
+        columns=["SureChEMBL_ID", "InChIKey"] if collapse else ["SureChEMBL_ID"])
+    ids = table["SureChEMBL_ID"]
+    print("All compounds:", len(ids))
+
+    if not collapse:
+        unique_cpds = list(set(ids.tolist()))
+        print("Unique cpds:", len(unique_cpds))
+
+        cpd_dict = dict(zip(unique_cpds, np.arange(0, len(unique_cpds), 1)))
+
+        pickle.dump(cpd_dict, file=open(fp + "cpd_ID_index_dict.p", "wb"))
+        return
 
-    cpd_dict = dict(zip(unique_cpds, np.arange(0, len(unique_cpds), 1)))
+    #Parent key: connectivity block of the InChIKey (or the id itself)
+    table = table.drop_duplicates("SureChEMBL_ID")
+    parents = table["InChIKey"].str[:14].where(table["InChIKey"] != "",
+                                                table["SureChEMBL_ID"])
+    parent_index, parent_names = pd.factorize(parents)
+    print("Unique cpds:", len(table))
+    print("Parent cpds:", len(parent_names))
 
-    pickle.dump(cpd_dict, file=open(fp + "cpd_ID_index_dict.p", "wb"))
+    cpd_dict = dict(zip(table["SureChEMBL_ID"], parent_index))
+    members = pd.Series(table["SureChEMBL_ID"].to_numpy()).groupby(
+        parent_index).agg(list)
 
+    pickle.dump(cpd_dict, file=open(fp + "cpd_parent_index_dict.p", "wb"))
+    pickle.dump({
+        "names": list(parent_names),
+        "members": members.tolist()
+    },
+                file=open(fp + "cpd_parent_members.p", "wb"))
 
-def build_patent_ID_mapping(updates, fp):
+
+def expand_parents(parent_members, parents):
+    """ Expands parent compound indicies back to their member SureChemBL ids
+
+    Args:
+        parent_members (dict): reverse map from cpd_parent_members.p
+        parents (list): parent indicies (e.g. igraph compound vertices)
+
+    Returns:
+        list: list of member SureChemBL ids of each parent
+    """
+    return [parent_members["members"][parent] for parent in parents]
+
+
+#SureChEMBL patent ids are "<country>-<number>-<kind>", e.g. "EP-1234567-B1"
+_KIND_CODE = re.compile(r"-[A-Z][0-9]?$")
+
+
+def normalize_patent(patent, mode="kind", families=None):
+    """ Key shared by equivalent publications of a patent
+
+    Args:
+        patent (string): SureChEMBL patent id
+        mode (string): "kind" strips the kind code, so publications of one number
+            (e.g. EP A1/B1, WO A1/A3) share a key; "family" looks the patent up in
+            families, falling back to "kind"
+        families (dict): links patent ids (with or without kind codes) to
+            family ids, e.g. from an external family table - only used by "family"
+
+    Returns:
+        string: normalized patent key
+    """
+    key = _KIND_CODE.sub("", patent)
+    if mode == "family" and families is not None:
+        return families.get(patent, families.get(key, key))
+    return key
+
+
+def build_patent_ID_mapping(updates, fp, normalize=None, families=None):
     """ Build a mapping between patents and igraph indicies (0-len(patents))
 
+    With normalize set, equivalent patents (see normalize_patent()) are merged
+    before indexing and share an index, so they become a single patent vertex.
+    replaceIds() and build_bipartite_edgelist() then merge their compounds.
+
     Args:
         updates (list): list of months
         fp (string): filepath to GDrive patent info
+        normalize (string): normalize_patent() mode ("kind" or "family"), or None
+            to keep every patent id separate
+        families (dict): patent family ids, for normalize="family"
 
     Returns:
-        None: saves patent indicies to fp+"patent_ID_index_dict.p"
+        None: saves patent indicies to fp+"patent_ID_index_dict.p" (or, when
+            normalizing, fp+"patent_group_index_dict.p" and the reverse map
+            fp+"patent_group_members.p")
     """
     patents = []
     for update in tqdm(updates):
@@ -446,9 +531,30 @@ def build_patent_ID_mapping(updates, fp):
     print("Unique patents:", len(unique_patents))
     print(patents[0:100])
 
-    patent_ids = dict(zip(unique_patents, np.arange(0, len(unique_patents), 1)))
+    if normalize is None:
+        patent_ids = dict(
+            zip(unique_patents, np.arange(0, len(unique_patents), 1)))
 
-    pickle.dump(patent_ids, file=open(fp + "patent_ID_index_dict.p", "wb"))
+        pickle.dump(patent_ids, file=open(fp + "patent_ID_index_dict.p", "wb"))
+        return
+
+    groups = [
+        normalize_patent(patent, normalize, families)
+        for patent in unique_patents
+    ]
+    group_index, group_names = pd.factorize(pd.Series(groups))
+    print("Patent groups:", len(group_names), "(",
+          len(unique_patents) - len(group_names), "patent nodes saved )")
+
+    patent_ids = dict(zip(unique_patents, group_index))
+    members = pd.Series(unique_patents).groupby(group_index).agg(list)
+
+    pickle.dump(patent_ids, file=open(fp + "patent_group_index_dict.p", "wb"))
+    pickle.dump({
+        "names": list(group_names),
+        "members": members.tolist()
+    },
+                file=open(fp + "patent_group_members.p", "wb"))
 
 
 def replaceIds(updates, fp, cpd_id_dict, patent_id_dict):
@@ -463,18 +569,26 @@ def replaceIds(updates, fp, cpd_id_dict, patent_id_dict):
     Returns:
         none: saves each update to a pickle file
     """
-    #number to add to patents to avoid duplicate igraph indicies
-    num_cpds = len(cpd_id_dict)
+    #number to add to patents to avoid duplicate igraph indicies (compounds may
+    # share a parent index, see build_cpd_ID_mapping())
+    num_cpds = max(cpd_id_dict.values()) + 1
     print("Num Cpds:", num_cpds)
-    print("Num patents:", len(patent_id_dict))
+    print("Num patents:", max(patent_id_dict.values()) + 1)
 
     print("Max cpd value:", max(cpd_id_dict.values()))
     print("Max patent value:", max(patent_id_dict.values()))
 
-    for update in tqdm(updates):
-        patent_cpd_edges = pickle.load(
-            file=open(fp + "patent_cpd_edges_" + update + ".p", "rb"))
+    #Load upcoming months & save finished months in the background
+    months = month_pipeline.prefetch(
+        updates, lambda update: month_pipeline.load_pickle(
+            fp + "patent_cpd_edges_" + update + ".p"))
+    writer = month_pipeline.AsyncWriter()
+
+    #Edges before & after merging compounds/patents which share an index
+    total_edges = 0
+    merged_edges = 0
 
+    for update, patent_cpd_edges in tqdm(months, total=len(updates)):
         patent_id_edges = {}  #New dictionary to hold patent/id relations
 
         #Track number of compounds that do not appear in SureChemBL compound list
@@ -492,11 +606,22 @@ def replaceIds(updates, fp, cpd_id_dict, patent_id_dict):
                     failed += 1  #Count failures if compound doesn't appear in cp_id_dict
 
             #Link patent index with all compound indicies associated with it
-            patent_id_edges[patent_id_dict[patent] + num_cpds] = indicies
+            # (merging repeated indicies, e.g. compounds with the same parent,
+            # or patents in the same group)
+            patent_index = patent_id_dict[patent] + num_cpds
+            total_edges += len(indicies)
+            merged_edges -= len(patent_id_edges.get(patent_index, []))
+            patent_id_edges[patent_index] = list(
+                dict.fromkeys(patent_id_edges.get(patent_index, []) + indicies))
+            merged_edges += len(patent_id_edges[patent_index])
 
         #Save each month's edges
-        pickle.dump(patent_id_edges,
-                    file=open(fp + "patent_id_edges" + update + ".p", "wb"))
+        writer.submit(month_pipeline.dump_pickle, patent_id_edges,
+                      fp + "patent_id_edges" + update + ".p")
+
+    writer.close()
+    print("Edges:", merged_edges, "of", total_edges, "(", total_edges - merged_edges,
+          "merged within months )")
 
 
 def build_cpd_edgelist(updates, fp):
@@ -532,12 +657,14 @@ def build_cpd_edgelist(updates, fp):
     del (edgelist)
 
 
-def build_bipartite_edgelist(updates, fp):
+def build_bipartite_edgelist(updates, fp, merge=False):
     """ Builds patent-cpd edges using igraph indicies
 
     Args:
         updates (list): list of months (YYYY-MM format)
         fp (string): filepath to CpdPatentIdsDates directory
+        merge (bool): remove repeated edges - needed when patent groups span several
+            months (see build_patent_ID_mapping())
 
     Returns:
         None: saves edges to pickle file (index_edgelist_bipartite.p in CpdPatentIdsDates)
@@ -545,10 +672,10 @@ def build_bipartite_edgelist(updates, fp):
     edges = []
     max_value = 0
 
-    for update in updates:
-        patent_index_edges = pickle.load(
-            file=open(fp + "patent_id_edges" + update + ".p", "rb"))
-
+    months = month_pipeline.prefetch(
+        updates, lambda update: month_pipeline.load_pickle(
+            fp + "patent_id_edges" + update + ".p"))
+    for update, patent_index_edges in months:
         for patent, cpds in patent_index_edges.items():
             if patent > max_value:
                 max_value = patent
@@ -557,6 +684,16 @@ def build_bipartite_edgelist(updates, fp):
                 edges.append((patent,
                               cpd))
 
+    if merge:
+        num_edges = len(edges)
+        edges = [
+            tuple(edge)
+            for edge in np.unique(np.array(edges, dtype=np.int64).reshape(-1, 2),
+                                  axis=0).tolist()
+        ]
+        print("Edges:", len(edges), "of", num_edges, "(",
+              num_edges - len(edges), "repeated edges merged )")
+
     pickle.dump(edges,
                 file=open(
                     "/scratch/jmalloy3/Patents/index_edgelist_bipartite.p",
@@ -566,23 +703,35 @@ def build_bipartite_edgelist(updates, fp):
     return edges
 
 
-def build_full_bipartite_network(edgelist, cpd_id_dict, patent_id_dict):
+def build_full_bipartite_network(edgelist,
+                                 cpd_id_dict,
+                                 patent_id_dict,
+                                 cpd_names=None,
+                                 patent_names=None):
     """ Builds full igraph network containing patents and compounds
 
     Args:
         edgelist (list of sets): list of all edges between patent & compound indicies
         cpd_id_dict (dict): links SureChemBL cpd ids with igraph indicies
         patent_id_dict (dict): links patent ids with igraph indicies
+        cpd_names (list): name of each compound vertex (default: SureChemBL ids;
+            parent names from cpd_parent_members.p when compounds are collapsed)
+        patent_names (list): name of each patent vertex (default: patent ids;
+            group names from patent_group_members.p when patents are merged)
     """
-    print("Sum of cpd & patent id dicts is:",
-          len(cpd_id_dict) + len(patent_id_dict))
+    if cpd_names is None:
+        cpd_names = [*cpd_id_dict]
+    if patent_names is None:
+        patent_names = [*patent_id_dict]
+    print("Sum of cpd & patent vertices is:",
+          len(cpd_names) + len(patent_names))
     G = ig.Graph()
 
     #Add nodes
-    G.add_vertices(len(cpd_id_dict) + len(patent_id_dict))
-    G.vs["name"] = [*cpd_id_dict] + [*patent_id_dict]
+    G.add_vertices(len(cpd_names) + len(patent_names))
+    G.vs["name"] = cpd_names + patent_names
     #Type is cpd/patent to distinguish bipartite nature of nodes
-    G.vs["type"] = [0]*len(cpd_id_dict) + [1]*len(patent_id_dict)
+    G.vs["type"] = [0]*len(cpd_names) + [1]*len(patent_names)
 
     #Add edges
     G.add_edges(edgelist)
@@ -693,6 +842,7 @@ def main():
     # fp = "Data/CpdPatentIdsDates/"
     # fp = "G:\\Shared Drives\\SureChemBL_Patents\\Cpd_Data\\"
     # build_cpd_ID_mapping(fp)
+    # build_cpd_ID_mapping(fp, collapse=True)  #Parent-level (stereo-insensitive) compounds
 
     #Load cpd-id dictionary
     #cpd_id_dict = pickle.load(file=open(fp + "cpd_ID_index_dict.p", "rb"))
@@ -710,6 +860,7 @@ def main():
 
     # #Step 1: build patent-id dictionary - should only be run once
     # build_patent_ID_mapping(updates, fp)
+    # build_patent_ID_mapping(updates, fp, normalize="kind")  #Merge kind codes (patent_group_*.p)
 
     # #Step 2: Update patent-cpd-id files to include patent ids
     # #Load cpd-id dictionary - should only be run once
@@ -744,6 +895,19 @@ def main():
     print("Num patents:", len(patent_id_dict))
 
     build_full_bipartite_network(edgelist, cpd_id_dict, patent_id_dict)
+
+    # #Parent-level network (cpd_parent_index_dict.p used in Steps 2-3 instead)
+    # cpd_id_dict = pickle.load(file=open("Data/cpd_parent_index_dict.p", "rb"))
+    # parent_members = pickle.load(file=open("Data/cpd_parent_members.p", "rb"))
+    # build_full_bipartite_network(edgelist, cpd_id_dict, patent_id_dict,
+    #                              parent_members["names"])
+
+    # #Merged-patent network (patent_group_index_dict.p used in Steps 2-3, with
+    # # build_bipartite_edgelist(updates, fp, merge=True))
+    # patent_id_dict = pickle.load(file=open("Data/patent_group_index_dict.p", "rb"))
+    # patent_members = pickle.load(file=open("Data/patent_group_members.p", "rb"))
+    # build_full_bipartite_network(edgelist, cpd_id_dict, patent_id_dict,
+    #                              patent_names=patent_members["names"])
     #
     # Step 5: Add cpd names & patent ids
 
@@ -0,0 +1,468 @@
+""" Columnar on-disk SureChemBL compound table with hashed lookup indices
+
+The full compound table (~21M rows) is stored one column per file, so readers
+open it through memory maps and only read the columns and rows they need.
+Hash indices map SureChEMBL_ID, InChI and InChIKey values to row offsets, for
+O(1) single lookups and vectorized batch lookups without scanning the table.
+
+Layout of a table directory:
+    meta.p                    number of rows, and the kind of each column
+    <column>.npy              numeric column
+    <column>.off.npy          string column: int64 offsets (rows + 1)
+    <column>.bin.npy          string column: concatenated utf-8 bytes
+    index_<column>.hash.npy   hash index: uint64 hash in each slot (0 = empty)
+    index_<column>.row.npy    hash index: int64 row of each slot
+
+Missing strings are stored as empty strings.
+
+"""
+
+import os
+import pickle
+import shutil
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+
+#Columns indexed by build_indices()
+INDEX_COLUMNS = ["SureChEMBL_ID", "InChI", "InChIKey"]
+
+
+def _column_path(fp, name, suffix):
+    return os.path.join(fp, name + suffix)
+
+
+def write_table(df, fp):
+    """ Writes a dataframe to a columnar table directory
+
+    Args:
+        df (pandas dataframe): compound data (e.g. SureChEMBL_ID, SMILES, InChI, InChIKey)
+        fp (string): filepath to the table directory (created if missing)
+    """
+    os.makedirs(fp, exist_ok=True)
+    columns = {}
+
+    for name in df.columns:
+        values = df[name]
+        if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(
+                values):
+            np.save(_column_path(fp, name, ".npy"), values.to_numpy())
+            columns[name] = "num"
+        else:
+            encoded = [
+                v.encode("utf-8") if isinstance(v, str) else b""
+                for v in values.tolist()
+            ]
+            lengths = np.fromiter((len(v) for v in encoded),
+                                  dtype=np.int64,
+                                  count=len(encoded))
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+
+            np.save(_column_path(fp, name, ".off.npy"), offsets)
+            np.save(_column_path(fp, name, ".bin.npy"),
+                    np.frombuffer(b"".join(encoded), dtype=np.uint8))
+            columns[name] = "str"
+
+    pickle.dump({
+        "n": len(df),
+        "columns": columns
+    },
+                file=open(os.path.join(fp, "meta.p"), "wb"))
+
+
+def open_table(fp):
+    """ Opens a columnar table without reading any column data
+
+    Args:
+        fp (string): filepath to the table directory
+
+    Returns:
+        dict: table metadata ("fp", "n", "columns")
+    """
+    table = pickle.load(file=open(os.path.join(fp, "meta.p"), "rb"))
+    table["fp"] = fp
+    table["arrays"] = {}
+
+    return table
+
+
+def _array(table, name, suffix):
+    """ Memory-maps (and caches) a single column file of a table """
+    key = name + suffix
+    if key not in table["arrays"]:
+        table["arrays"][key] = np.load(_column_path(table["fp"], name, suffix),
+                                       mmap_mode="r")
+    return table["arrays"][key]
+
+
+def read_column(table, name, rows=None):
+    """ Reads one column of a table, for all rows, a row range, or a list of rows
+
+    Args:
+        table (dict): opened table, from open_table()
+        name (string): column name
+        rows (slice, list or numpy array): rows to read (default: all rows)
+
+    Returns:
+        numpy array: column values (object array of strings for string columns)
+    """
+    if rows is None:
+        rows = slice(0, table["n"])
+
+    if table["columns"][name] == "num":
+        return np.asarray(_array(table, name, ".npy")[rows])
+
+    offsets = _array(table, name, ".off.npy")
+    data = _array(table, name, ".bin.npy")
+
+    if isinstance(rows, slice):
+        start, stop, step = rows.indices(table["n"])
+        if step == 1:
+            #Contiguous range - one read, then split by offsets
+            bounds = np.asarray(offsets[start:stop + 1])
+            block = data[bounds[0]:bounds[-1]].tobytes()
+            bounds = bounds - bounds[0]
+            return np.array([
+                block[bounds[i]:bounds[i + 1]].decode("utf-8")
+                for i in range(len(bounds) - 1)
+            ],
+                            dtype=object)
+        rows = np.arange(start, stop, step)
+
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = np.asarray(offsets[rows])
+    stops = np.asarray(offsets[rows + 1])
+
+    return np.array([
+        data[s:e].tobytes().decode("utf-8") for s, e in zip(starts, stops)
+    ],
+                    dtype=object)
+
+
+def read_table(fp, columns=None, rows=None):
+    """ Reads selected columns and rows of a table into a dataframe
+
+    Args:
+        fp (string): filepath to the table directory
+        columns (list): columns to read (default: all columns)
+        rows (slice, list or numpy array): rows to read (default: all rows)
+
+    Returns:
+        pandas dataframe: the selected data
+    """
+    table = open_table(fp)
+    if columns is None:
+        columns = list(table["columns"])
+
+    return pd.DataFrame({name: read_column(table, name, rows) for name in columns})
+
+
+def _parse_part(args):
+    """ Parses one SureChEMBL compound file into a part table (run in a worker)
+
+    Args:
+        args (tuple): (filepath to a tab-separated compound file, part table filepath)
+
+    Returns:
+        string: part table filepath
+    """
+    fp, part_fp = args
+    write_table(pd.read_csv(fp, sep="\t", header=0), part_fp)
+
+    return part_fp
+
+
+def _string_part(table, name):
+    """ Offsets and bytes of one column of a part table, as a string column
+
+    A numeric part of a string column (e.g. a file where every value is missing)
+    is encoded as strings, with NaN as an empty string.
+
+    Returns:
+        tuple: (int64 offsets, uint8 bytes)
+    """
+    if table["columns"][name] == "str":
+        return _array(table, name, ".off.npy"), _array(table, name, ".bin.npy")
+
+    encoded = [
+        b"" if pd.isna(v) else str(v).encode("utf-8")
+        for v in read_column(table, name)
+    ]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(v) for v in encoded], out=offsets[1:])
+
+    return offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+
+def concat_tables(part_fps, fp):
+    """ Concatenates part tables (with the same columns) into a single table
+
+    String columns are streamed part by part into memory-mapped output files, so
+    the full table is never held in memory.
+
+    Args:
+        part_fps (list): filepaths to part tables, in row order
+        fp (string): filepath to the output table directory
+    """
+    os.makedirs(fp, exist_ok=True)
+    parts = [open_table(part_fp) for part_fp in part_fps]
+    names = list(parts[0]["columns"])
+    n = sum(part["n"] for part in parts)
+    columns = {}
+
+    for name in names:
+        kinds = {part["columns"][name] for part in parts}
+        kind = "num" if kinds == {"num"} else "str"
+        columns[name] = kind
+
+        if kind == "num":
+            np.save(_column_path(fp, name, ".npy"),
+                    np.concatenate([read_column(part, name) for part in parts]))
+            continue
+
+        sources = [_string_part(part, name) for part in parts]
+        offsets = np.lib.format.open_memmap(_column_path(fp, name, ".off.npy"),
+                                            mode="w+",
+                                            dtype=np.int64,
+                                            shape=(n + 1,))
+        data = np.lib.format.open_memmap(
+            _column_path(fp, name, ".bin.npy"),
+            mode="w+",
+            dtype=np.uint8,
+            shape=(sum(len(part_data) for _, part_data in sources),))
+        offsets[0] = 0
+        row = 0
+        position = 0
+        for part_offsets, part_data in sources:
+            rows = len(part_offsets) - 1
+            offsets[row + 1:row + rows + 1] = part_offsets[1:] + position
+            data[position:position + len(part_data)] = part_data
+            row += rows
+            position += len(part_data)
+        offsets.flush()
+        data.flush()
+        del (offsets)
+        del (data)
+
+    pickle.dump({
+        "n": n,
+        "columns": columns
+    },
+                file=open(os.path.join(fp, "meta.p"), "wb"))
+
+
+def build_table(data_fp, fp, processes=None):
+    """ Parses all SureChEMBL compound .txt files in parallel into a columnar table
+
+    Each file is parsed into its own part table by a worker process, and the parts
+    are concatenated in file-name order. Hash indices are then built over the id
+    columns (see build_indices()).
+
+    Args:
+        data_fp (string): directory holding the SureChEMBL compound .txt files
+        fp (string): filepath to the output table directory
+        processes (int): number of parsing processes (default: one per file, up to
+            the number of cores)
+    """
+    files = sorted(f for f in os.listdir(data_fp) if f.endswith(".txt"))
+    parts_fp = os.path.join(fp, "parts")
+    tasks = [(os.path.join(data_fp, f), os.path.join(parts_fp, str(i)))
+             for i, f in enumerate(files)]
+
+    print("-- Parsing", len(files), "compound files --")
+    pool = mp.Pool(processes or min(len(files), mp.cpu_count()))
+    part_fps = pool.map(_parse_part, tasks, chunksize=1)
+    pool.close()
+    pool.join()
+
+    print("-- Concatenating parts --")
+    concat_tables(part_fps, fp)
+    shutil.rmtree(parts_fp)
+
+    build_indices(fp)
+
+
+def hash_keys(keys):
+    """ Stable 64-bit hashes of string keys (never 0, which marks an empty slot)
+
+    Args:
+        keys (list): string keys
+
+    Returns:
+        numpy array: uint64 hash of each key
+    """
+    hashes = pd.util.hash_array(np.asarray(keys, dtype=object),
+                                categorize=False)
+    hashes[hashes == 0] = 1
+
+    return hashes
+
+
+def build_index(fp, column):
+    """ Builds an open-addressing hash index over one column of a table
+
+    Duplicate values map to their first row, and missing (empty) values are not
+    indexed. The index has at least twice as many slots as rows, so lookups probe
+    about one slot on average.
+
+    Args:
+        fp (string): filepath to the table directory
+        column (string): column to index
+    """
+    table = open_table(fp)
+    keys = read_column(table, column)
+    rows = np.flatnonzero(~pd.Index(keys).duplicated(keep="first") &
+                          (keys != ""))
+    hashes = hash_keys(keys[rows])
+    del (keys)
+
+    size = 1 << max(1, int(2 * max(1, len(rows)) - 1).bit_length())
+    mask = np.uint64(size - 1)
+    slot_hashes = np.zeros(size, dtype=np.uint64)
+    slot_rows = np.full(size, -1, dtype=np.int64)
+
+    #Linear probing, resolved for all keys at once: each round, every unplaced
+    #key claims its slot if empty (first key wins), others move to the next slot
+    slots = (hashes & mask).astype(np.int64)
+    pending = np.arange(len(rows))
+    while len(pending):
+        candidate = slots[pending]
+        empty = slot_hashes[candidate] == 0
+        _, first = np.unique(candidate, return_index=True)
+        claims = np.zeros(len(pending), dtype=bool)
+        claims[first] = True
+        claims &= empty
+
+        placed = pending[claims]
+        slot_hashes[slots[placed]] = hashes[placed]
+        slot_rows[slots[placed]] = rows[placed]
+
+        pending = pending[~claims]
+        slots[pending] = (slots[pending] + 1) & (size - 1)
+
+    np.save(_column_path(fp, "index_" + column, ".hash.npy"), slot_hashes)
+    np.save(_column_path(fp, "index_" + column, ".row.npy"), slot_rows)
+
+
+def build_indices(fp, columns=INDEX_COLUMNS):
+    """ Builds hash indices over the id columns of a table
+
+    Args:
+        fp (string): filepath to the table directory
+        columns (list): columns to index
+    """
+    for column in columns:
+        print("-- Indexing", column, "--")
+        build_index(fp, column)
+
+
+def open_index(fp, column):
+    """ Opens a hash index (memory-mapped) for lookups
+
+    Args:
+        fp (string): filepath to the table directory
+        column (string): indexed column
+
+    Returns:
+        dict: index arrays, the table, and the indexed column name
+    """
+    return {
+        "hash": np.load(_column_path(fp, "index_" + column, ".hash.npy"),
+                        mmap_mode="r"),
+        "row": np.load(_column_path(fp, "index_" + column, ".row.npy"),
+                       mmap_mode="r"),
+        "table": open_table(fp),
+        "column": column
+    }
+
+
+def lookup_rows(index, keys):
+    """ Finds the table row of many keys at once
+
+    Matching hashes are confirmed against the stored column value, so hash
+    collisions never return a wrong row.
+
+    Args:
+        index (dict): opened index, from open_index()
+        keys (list): values of the indexed column to find
+
+    Returns:
+        numpy array: int64 row of each key (-1 if not found)
+    """
+    keys = np.asarray(list(keys), dtype=object)
+    rows = np.full(len(keys), -1, dtype=np.int64)
+    if len(keys) == 0:
+        return rows
+
+    slot_hashes = index["hash"]
+    size = len(slot_hashes)
+    hashes = hash_keys(keys)
+    slots = (hashes & np.uint64(size - 1)).astype(np.int64)
+
+    pending = np.arange(len(keys))
+    while len(pending):
+        found_hashes = np.asarray(slot_hashes[slots[pending]])
+
+        #Empty slot - key is not in the table
+        pending = pending[found_hashes != 0]
+        found_hashes = found_hashes[found_hashes != 0]
+
+        match = found_hashes == hashes[pending]
+        if match.any():
+            candidates = pending[match]
+            candidate_rows = np.asarray(index["row"][slots[candidates]])
+            values = read_column(index["table"], index["column"],
+                                 candidate_rows)
+            confirmed = values == keys[candidates]
+            rows[candidates[confirmed]] = candidate_rows[confirmed]
+            resolved = np.zeros(len(pending), dtype=bool)
+            resolved[np.flatnonzero(match)[confirmed]] = True
+            pending = pending[~resolved]
+
+        slots[pending] = (slots[pending] + 1) % size
+
+    return rows
+
+
+def lookup_row(index, key):
+    """ Finds the table row of a single key
+
+    Args:
+        index (dict): opened index, from open_index()
+        key (string): value of the indexed column to find
+
+    Returns:
+        int: row of the key (-1 if not found)
+    """
+    return int(lookup_rows(index, [key])[0])
+
+
+def lookup(fp, column, keys, columns=None):
+    """ Looks up compound data for many keys of one indexed column
+
+    Args:
+        fp (string): filepath to the table directory
+        column (string): indexed column the keys belong to (e.g. "InChI")
+        keys (list): values to find
+        columns (list): columns to return (default: all columns)
+
+    Returns:
+        pandas dataframe: one row per key, in the order given, plus a "row" column
+            (-1 and empty values for keys which are not in the table)
+    """
+    index = open_index(fp, column)
+    rows = lookup_rows(index, keys)
+    found = rows >= 0
+
+    table = index["table"]
+    if columns is None:
+        columns = list(table["columns"])
+
+    df = pd.DataFrame({"row": rows})
+    for name in columns:
+        values = np.full(len(rows), None, dtype=object)
+        values[found] = read_column(table, name, rows[found])
+        df[name] = values
+
+    return df
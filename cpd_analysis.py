@@ -1,43 +1,247 @@
 # import igraph as ig
-# import numpy as np
+import numpy as np
 import pickle
 import pandas as pd
 from tqdm import tqdm
 import os
-import heapq
-import scipy.stats as stats
-from random import sample
+import degree_store
+import compound_store
+import fingerprint_index
 
 
-def build_cpd_df(fp):
-    """ Takes 29 separate compound data files and combines them into a single pandas dataframe for ease of access
+def build_cpd_df(fp, processes=None):
+    """ Parses 29 separate compound data files (in parallel) into a single columnar table
 
     Args:
         fp (string): Filepath to SureChemBL data files (assuming G drive goes to jmalloy3 Google Account)
+        processes (int): number of parsing processes (default: one per file, up to the number of cores)
 
     Returns:
-        None - but does write a pickled dataframe to SureChemBL_Patents/Cpd_Data/ directory
+        None - but does write a columnar table (with id/InChI/InChIKey indices) to
+            SureChemBL_Patents/Cpd_Data/SureChemBL_allCpds/ (see compound_store.py)
     """
-    dfs = []
-    for f in tqdm(os.listdir(fp)):
-        if f.endswith(".txt"):
-            dfs.append(pd.read_csv(fp + f, sep="\t", header=0))
+    compound_store.build_table(fp, os.path.join(fp, "SureChemBL_allCpds"),
+                               processes)
 
-    df = pd.concat(dfs, ignore_index=True)
-    print(df)
-    pickle.dump(df, file=open(fp + "SureChemBL_allCpds.p", "wb"))
 
-    del df
+def sort_scores(values):
+    """ Sorts a population of scores once, for repeated percentile queries
 
+    Args:
+        values (array-like): population of scores (NaNs are dropped)
+
+    Returns:
+        numpy array: sorted float64 scores
+    """
+    values = np.asarray(values, dtype=np.float64)
+    return np.sort(values[~np.isnan(values)])
+
+
+def percentile_ranks(sorted_values, scores):
+    """ Finds the percentile rank of many scores within a sorted population
+
+    Matches scipy.stats.percentileofscore(values, score) (kind="rank") for each
+    score, using two binary searches instead of a full pass over the population.
+
+    Args:
+        sorted_values (numpy array): sorted population, from sort_scores()
+        scores (array-like): scores to rank
+
+    Returns:
+        numpy array: percentile (0-100) of each score (NaN for NaN scores)
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    n = len(sorted_values)
+    if n == 0:
+        return np.full(scores.shape, np.nan)
+
+    left = np.searchsorted(sorted_values, scores, side="left")
+    right = np.searchsorted(sorted_values, scores, side="right")
+    #Average rank of ties, plus one if the score itself is in the population
+    percentiles = (left + right + (right > left)) * 50.0 / n
+    percentiles[np.isnan(scores)] = np.nan
+
+    return percentiles
+
+
+def load_attachment_data(fp):
+    """ Loads final degrees & preferential attachment values from a degree store
+
+    Only compounds which appear within the store's date range (nonzero final degree)
+    are kept as the population for attachment percentiles.
+
+    Args:
+        fp (string): filepath to a degree store directory (see degree_store.py)
+
+    Returns:
+        store (dict): opened degree store, for id lookups
+        final_degrees (numpy array): final degree of every store row
+        pref_attach_values (numpy array): sorted attachment values of all present
+            compounds, for percentile_ranks()
+    """
+    store = degree_store.open_degree_store(fp)
+    final_degrees = np.array(store["final_degree"])
+    attachments = np.array(store["attachment"])
+
+    return store, final_degrees, sort_scores(attachments[final_degrees > 0])
+
+
+def iter_window_metrics(index_fp, increments):
+    """ Computes attachment values & window degrees of every compound, window by window
+
+    Uses the cumulative degree index (see get_cpd_network_data.build_cumulative_index()),
+    so each window is a single vectorized pass over all compounds.
+
+    Args:
+        index_fp (string): filepath to a pickled cumulative degree index
+        increments (list): list of (start, stop) year tuples
+
+    Yields:
+        ids (numpy array): SureChemBL id of each index row (first item only)
+        label (string): "<start>_<stop>" label of the window
+        attachments (numpy array): attachment value of each compound (NaN if absent)
+        window_degrees (numpy array): degree gained by each compound within the window
+    """
+    #Imported here, so the compound table analyses do not need igraph/scipy
+    import get_cpd_network_data as cpd_network
+
+    index = pickle.load(file=open(index_fp, "rb"))
+    prefix = index["prefix"]
+    keys = cpd_network.prefix_keys(prefix)
+
+    yield index["ids"]
+    for window_start, window_stop in tqdm(increments):
+        a = (window_start - index["start"]) * 12
+        b = (window_stop - index["start"]) * 12 + 11
+        attachments, window_degrees = cpd_network.window_attachment(
+            prefix, a, b, keys)
+        attachments[window_degrees == 0] = np.nan
+
+        yield str(window_start) + "_" + str(
+            window_stop), attachments, window_degrees
+
+
+def window_percentile_columns(index_fp, increments):
+    """ Finds the attachment percentile of every compound for many year windows
+
+    Each window's attachment values are sorted once and ranked for all compounds
+    at once.
+
+    Args:
+        index_fp (string): filepath to a pickled cumulative degree index
+        increments (list): list of (start, stop) year tuples
+
+    Returns:
+        pandas dataframe: SureChemBL id index, one float32 percentile column per
+            window ("<start>_<stop>"), NaN where a compound is absent from a window
+    """
+    windows = iter_window_metrics(index_fp, increments)
+    ids = next(windows)
+
+    columns = {}
+    for label, attachments, _ in windows:
+        percentiles = percentile_ranks(sort_scores(attachments), attachments)
+        columns[label] = percentiles.astype(np.float32)
+
+    return pd.DataFrame(columns, index=pd.Index(ids, name="SureChEMBL_ID"))
+
+
+def top_k_rows(values, k):
+    """ Finds the rows of the k largest values with a partial selection
+
+    Uses numpy.argpartition (linear time) and only sorts the k selected rows.
+    NaN values rank below every other value. For a 1D array they are never
+    selected (fewer than k rows are returned if fewer than k values are valid);
+    for a 2D array every column gets k rows, and rows with NaN values come last.
+
+    Args:
+        values (numpy array): 1D array of values, or 2D array (rows x columns) to
+            select the top k of every column at once
+        k (int): number of rows to select
+
+    Returns:
+        numpy array: row indices, largest first ((k,) or (k, columns))
+    """
+    values = np.where(np.isnan(values), -np.inf, values).astype(np.float64)
+    k = min(k, values.shape[0])
+    if k == 0:
+        return np.zeros((0,) + values.shape[1:], dtype=np.int64)
+
+    #Partition so the k largest values come first, then order just those k
+    top = np.argpartition(-values, k - 1, axis=0)[:k]
+    order = np.argsort(-np.take_along_axis(values, top, axis=0),
+                       axis=0,
+                       kind="stable")
+
+    top = np.take_along_axis(top, order, axis=0)
+    if top.ndim == 1:
+        top = top[values[top] > -np.inf]
+
+    return top
+
+
+def top_k_by_window(index_fp, increments, k, metric="degree"):
+    """ Finds the top k compounds of every window by a given metric
+
+    Args:
+        index_fp (string): filepath to a pickled cumulative degree index
+        increments (list): list of (start, stop) year tuples
+        k (int): number of compounds per window
+        metric (string): "degree" (degree gained within the window), "attachment"
+            (attachment index), or "change" (attachment index minus the attachment
+            index of the previous window)
+
+    Returns:
+        pandas dataframe: window, rank, SureChEMBL_ID, and value of the metric
+    """
+    windows = iter_window_metrics(index_fp, increments)
+    ids = next(windows)
+
+    labels = []
+    columns = []
+    previous = None
+    for label, attachments, window_degrees in windows:
+        if metric == "degree":
+            column = window_degrees
+        elif metric == "attachment":
+            column = attachments
+        elif metric == "change":
+            column = attachments - previous if previous is not None else None
+            previous = attachments
+        else:
+            raise ValueError("Unknown metric: " + metric)
+
+        if column is not None:
+            labels.append(label)
+            columns.append(column.astype(np.float32))
+
+    if not columns:
+        return pd.DataFrame(columns=["window", "rank", "SureChEMBL_ID", metric])
+
+    #Top k of every window in a single partial selection
+    values = np.column_stack(columns)
+    del (columns)
+    top = top_k_rows(values, k)
+
+    df = pd.DataFrame({
+        "window": np.repeat(labels, top.shape[0]),
+        "rank": np.tile(np.arange(1, top.shape[0] + 1), len(labels)),
+        "SureChEMBL_ID": ids[top.T.ravel()],
+        metric: np.take_along_axis(values, top, axis=0).T.ravel()
+    })
+
+    #Windows with fewer than k valid values keep only their valid rows
+    return df[df[metric].notna()].reset_index(drop=True)
 
-def find_highest_degrees(df, n, start, stop):
+
+def find_highest_degrees(table_fp, n, start, stop):
     """ Finds the n highest-degree compounds within a specific date range
 
     Saves various data associated with those n comopunds - smiles, inchi,
     inchikey, degree, preferential attachment value
 
     Args:
-        df (pandas dataframe): dataframe containing all SureChemBL compounds
+        table_fp (string): filepath to the SureChemBL compound table (see compound_store.py)
         n (int): the number of highest-degree compounds to select
         start (int): 1st year of the range
         stop (int): last year of the range
@@ -45,57 +249,42 @@ def find_highest_degrees(df, n, start, stop):
     print("----------", start, stop, "----------")
 
     #Finding the top 10 preferential attachment compounds (from 1980-1984 as a test)
-    full_id_degrees = pickle.load(file=open(
+    store, final_degrees, pref_attach_values = load_attachment_data(
         "G:\\Shared drives\\SureChemBL_Patents\\Degrees\\full_id_degrees_" +
-        str(start) + "_" + str(stop) + ".p", "rb"))
-    pref_attach_dict = pickle.load(file=open(
-        "G:\\Shared drives\\SureChemBL_Patents\\pref_attach_dict_" +
-        str(start) + "_" + str(stop) + ".p", "rb"))
+        str(start) + "_" + str(stop))
 
     #Find n compounds with largest degree
-    highest_degree_cpds = heapq.nlargest(n,
-                                         full_id_degrees,
-                                         key=full_id_degrees.get)
-
-    highest_degree_cpds_df = df[df["SureChEMBL_ID"].isin(highest_degree_cpds)]
+    rows = top_k_rows(final_degrees, n)
+    highest_degree_cpds = store["ids"][rows].astype(str)
 
-    pref_attach_values = list(pref_attach_dict.values())
+    highest_degree_cpds_df = compound_store.lookup(table_fp, "SureChEMBL_ID",
+                                                   highest_degree_cpds)
 
     #Extra information to be added to the csv output file
-    degrees = []
-    pref_attach_highestCpd_values = []
-    pref_attach_percentiles = []
-
-    for cpd in tqdm(highest_degree_cpds_df["SureChEMBL_ID"]):
-        #Degree of compound
-        degrees.append(full_id_degrees[cpd][-1])
+    pref_attach_highestCpd_values = np.array(store["attachment"][rows])
 
-        #Preferential attachment value
-        pref_attach_highestCpd_values.append(pref_attach_dict[cpd])
-
-        #Percentile of preferential attachment value
-        pref_attach_percentiles.append(
-            stats.percentileofscore(pref_attach_values, pref_attach_dict[cpd]))
-
-    highest_degree_cpds_df["degree"] = degrees
+    highest_degree_cpds_df["degree"] = final_degrees[rows]
     highest_degree_cpds_df["pref_attach_value"] = pref_attach_highestCpd_values
-    highest_degree_cpds_df["pref_attach_percentile"] = pref_attach_percentiles
+    highest_degree_cpds_df["pref_attach_percentile"] = percentile_ranks(
+        pref_attach_values, pref_attach_highestCpd_values)
 
-    highest_degree_cpds_df.to_csv(
+    #Table row is only used for the lookup - keep the original csv columns
+    highest_degree_cpds_df.drop(columns="row").to_csv(
         "G:\\Shared drives\\SureChemBL_Patents\\Cpd_Data/highest_degree_data_" +
         str(start) + "_" + str(stop) + "_1000.csv")
 
     print()
 
 
-def find_llanos_cpds(fp, df):
+def find_llanos_cpds(fp, table_fp):
     """ Tests various compounds found in Llanos et al (2019) in SureChemBL data
 
     Llanos et al used Reaxys data to find the most popular compounds. This checks
     where those compounds appear, if at all, in SureChembL patent data
 
     Args:
-        df (pandas dataframe): dataframe of all SureChemBL chemistry
+        fp (string): filepath to write llanos_cpds.csv
+        table_fp (string): filepath to the SureChemBL compound table (see compound_store.py)
     """
 
     cpds_1980_2015_inchi = {
@@ -130,40 +319,81 @@ def find_llanos_cpds(fp, df):
     }
 
     #Find stats for Llanos compounds - use 2015 data for stats (I really need to make a consensus graph)
-    full_id_degrees = pickle.load(file=open(
-        "G:\\Shared drives\\SureChemBL_Patents\\Degrees\\full_id_degrees_2015_2019.p",
-        "rb"))
-    pref_attach_dict = pickle.load(file=open(
-        "G:\\Shared drives\\SureChemBL_Patents\\pref_attach_dict_2015_2019.p",
-        "rb"))
-    pref_attach_values = list(pref_attach_dict.values())
+    store, final_degrees, pref_attach_values = load_attachment_data(
+        "G:\\Shared drives\\SureChemBL_Patents\\Degrees\\full_id_degrees_2015_2019"
+    )
+
+    #Find SureChemBL ids of all Llanos compounds with a single batched lookup
+    llanos_df = compound_store.lookup(table_fp, "InChI",
+                                      list(cpds_1980_2015_inchi.values()),
+                                      ["SureChEMBL_ID"])
+    llanos_df["name"] = list(cpds_1980_2015_inchi.keys())
 
     #Loop through Llanos compounds
     with open(fp + "llanos_cpds.csv", "a") as f:
         f.write(
             "name,inchi,SureChemBL_ID,degree,pref_attach_value,pref_attach_percentile\n"
         )
-        for name, inchi in cpds_1980_2015_inchi.items():
-            s = df[df["InChI"] == inchi]
-            if not s.empty:  #if SureChemBL holds that compound, save id & stats
+        for name, inchi, cpd_row, cpd_id in zip(llanos_df["name"],
+                                                cpds_1980_2015_inchi.values(),
+                                                llanos_df["row"],
+                                                llanos_df["SureChEMBL_ID"]):
+            if cpd_row < 0:  #if SureChemBL lacks that compound, no name nor stats
+                f.write(name + ",\"" + inchi + "\",na,na,na,na\n")
+                continue
+
+            row = degree_store.lookup_rows(store, [cpd_id])[0]
+            if row >= 0:  #if the degree store holds that compound, save id & stats
                 #Degree of compound
-                degree = full_id_degrees[s.iloc[0]["SureChEMBL_ID"]][-1]
+                degree = final_degrees[row]
 
                 #Preferential attachment value
-                pref_attach_value = pref_attach_dict[s.iloc[0]["SureChEMBL_ID"]]
+                pref_attach_value = store["attachment"][row]
 
                 #Percentile of preferential attachment value
-                pref_attach_percentile = stats.percentileofscore(
-                    pref_attach_values,
-                    pref_attach_dict[s.iloc[0]["SureChEMBL_ID"]])
+                pref_attach_percentile = percentile_ranks(
+                    pref_attach_values, [pref_attach_value])[0]
 
-                f.write(name + ",\"" + inchi + "\"," +
-                        s.iloc[0]["SureChEMBL_ID"] + "," + str(degree) + "," +
+                f.write(name + ",\"" + inchi + "\"," + cpd_id + "," +
+                        str(degree) + "," +
                         str(pref_attach_value) + "," +
                         str(pref_attach_percentile) + "\n")
 
-            else:  #if not, no name nor stats
-                f.write(name + ",\"" + inchi + "\",na,na,na,na\n")
+            else:  #if not, only the id
+                f.write(name + ",\"" + inchi + "\"," + cpd_id + ",na,na,na\n")
+
+
+def find_similar_cpds(index_fp, table_fp, inchi, cpd_ids=None, k=100,
+                      threshold=0):
+    """ Finds the compounds most structurally similar to a query compound
+
+    Uses the Morgan fingerprint index of the compound table (see
+    fingerprint_index.py), e.g. to find which high-attachment compounds resemble
+    a given compound.
+
+    Args:
+        index_fp (string): filepath to the fingerprint index
+        table_fp (string): filepath to the SureChemBL compound table (see compound_store.py)
+        inchi (string): query compound
+        cpd_ids (list): SureChemBL ids to search among (default: all compounds)
+        k (int): number of compounds to find
+        threshold (float): minimum Tanimoto similarity
+
+    Returns:
+        pandas dataframe: row, similarity and compound data of each match
+    """
+    rows = None
+    if cpd_ids is not None:
+        rows = compound_store.lookup_rows(
+            compound_store.open_index(table_fp, "SureChEMBL_ID"), cpd_ids)
+        rows = rows[rows >= 0]
+
+    return fingerprint_index.similar_compounds(index_fp,
+                                               table_fp,
+                                               inchi=inchi,
+                                               k=k,
+                                               threshold=threshold,
+                                               rows=rows)
 
 
 def build_month_increments(start, stop):
@@ -189,104 +419,164 @@ def build_month_increments(start, stop):
     return months
 
 
-def sample_compounds_unique(n, months, cpds, cpd_df):
-    """ Sample compounds which are uniquely added in a specific month
+def build_month_cpds(monthly_cpds, months, table_fp, fp):
+    """ Stores the compounds of every month as compound table rows, in one flat array
 
-    This uniquess is determined by determing when a compound is added in a month
-    and has not been present in the patent record before that month.
+    Ids are resolved to compound table rows once here, so sampling never touches
+    ids or pickled monthly lists again. Ids missing from the table are dropped.
 
     Args:
-        n (int): Number of compounds to sample every month
-        months (list): list of months to sample from
-        cpds (list): all SureChemBL IDs of compounds added in a specific month
-        cpd_df (pandas dataframe): Master dataframe of all compounds
+        monthly_cpds (iterable): list of SureChemBL ids for each month (e.g.
+            unique_cpds_AllMonths.p, or a prefetch() of unique_cpds_<month>.p files)
+        months (list): month of each list, in the same order (format YYYY-MM)
+        table_fp (string): filepath to the SureChemBL compound table (see compound_store.py)
+        fp (string): filepath to save the month/compound data (pickle)
     """
-    sample_inchis = {}
-
-    print("----- Sampling unique compounds -----")
-    for i in tqdm(range(len(months))):
-        offset = 216 #Account for starting in 1980 instead of 1962
-
-        #Only sample if there are more than 1000 compounds
-        if len(cpds[i+offset]) > n:
-            sample_cpds = sample(cpds[i+offset], n)
-        else:
-            sample_cpds = cpds[i+offset]
-
-        sub_df = cpd_df[cpd_df["SureChEMBL_ID"].isin(sample_cpds)]
-        sample_inchis[months[i]] = list(sub_df["InChI"])
-
-    print("\n----- Saving compounds -----")
-    pickle.dump(sample_inchis, file=open("Data/sample_inchi_1000_NEW.p", "wb"))
-
-
-def sample_compounds(n1, n2, months, cpd_df):
-    """ Sample n compounds from each month, initially with overlap allowed
-    //TODO: fix so that only unique-to-that-month compounds are sampled
+    id_index = compound_store.open_index(table_fp, "SureChEMBL_ID")
+    rows = []
+    offsets = [0]
+
+    for cpds in tqdm(monthly_cpds, total=len(months)):
+        month_rows = compound_store.lookup_rows(id_index, list(cpds))
+        rows.append(month_rows[month_rows >= 0])
+        offsets.append(offsets[-1] + len(rows[-1]))
+
+    pickle.dump(
+        {
+            "months": list(months),
+            "offsets": np.array(offsets, dtype=np.int64),
+            "rows": np.concatenate(rows) if rows else np.zeros(0, np.int64)
+        },
+        file=open(fp, "wb"))
+
+
+def sample_compounds(sizes, months, month_fp, table_fp, seed=0):
+    """ Samples compounds of every month for several sample sizes in one pass
+
+    Each month is sampled once, without replacement, for the largest size; smaller
+    samples are prefixes of it (so the 100 sample is nested in the 1000 sample).
+    Every month has its own generator seeded from (seed, month), so a month's
+    sample does not depend on which other months are sampled. Months with fewer
+    compounds than a sample size contribute all of their compounds. InChIs of all
+    samples are then read from the compound table with a single batched read.
 
     Args:
-        n (int): number of compounds to sample
-        n2 (int): another number of compounds to sample
-        months (string): description of month, e.g. 1980-01
-        cpd_df (pandas dataframe): contains information for each compound in SureChemBL, including InChIKey
+        sizes (list): sample sizes (e.g. [100, 1000])
+        months (list): months to sample (format YYYY-MM)
+        month_fp (string): filepath to month/compound data, from build_month_cpds()
+        table_fp (string): filepath to the SureChemBL compound table (see compound_store.py)
+        seed (int): random seed
 
     Returns:
-        list: list of all randomly sampled compounds (in inchi?)
+        dict: {size: {month: list of InChIs}}
     """
-
-    #Inchis for all sampled compounds
-    sample_inchis_n1 = {}
-    sample_inchis_n2 = {}
+    month_cpds = pickle.load(file=open(month_fp, "rb"))
+    month_index = {month: i for i, month in enumerate(month_cpds["months"])}
+    offsets, rows = month_cpds["offsets"], month_cpds["rows"]
+    largest = max(sizes)
 
     print("----- Sampling Compounds ------\n")
+    samples = {}
     for month in tqdm(months):
-        cpds = pickle.load(file=open(
-            "G:\\Shared drives\\SureChemBL_Patents\\CpdPatentIdsDates\\unique_cpds_"
-            + month + ".p", "rb"))
-
-        sample_cpds_n1 = sample(cpds, n1)
-        sample_cpds_n2 = sample(cpds, n2)
+        i = month_index[month]
+        count = offsets[i + 1] - offsets[i]
+        rng = np.random.default_rng([seed, int(month.replace("-", ""))])
+        picks = rng.choice(count, min(largest, count), replace=False)
+        samples[month] = rows[offsets[i] + picks]
 
-        sub_df = cpd_df[cpd_df["SureChEMBL_ID"].isin(sample_cpds_n1)]
-        sample_inchis_n1[month] = list(sub_df["InChI"])
+    #Single read of the InChIs of every sampled compound
+    sampled_rows = np.unique(
+        np.concatenate([np.zeros(0, np.int64)] + list(samples.values())))
+    inchis = compound_store.read_column(compound_store.open_table(table_fp),
+                                        "InChI", sampled_rows)
 
-        sub_df = cpd_df[cpd_df["SureChEMBL_ID"].isin(sample_cpds_n2)]
-        sample_inchis_n2[month] = list(sub_df["InChI"])
+    sample_inchis = {size: {} for size in sizes}
+    for month, month_rows in samples.items():
+        month_inchis = inchis[np.searchsorted(sampled_rows, month_rows)]
+        for size in sizes:
+            sample_inchis[size][month] = list(month_inchis[:size])
 
-    #Save memory by removing cpd datframe and monthly compounds
-    del (cpd_df)
-    del (cpds)
-
-    #Save sampled inchis to pickle files
-    print("\n----- Saving Data -----")
-    pickle.dump(sample_inchis_n1, file=open("Data/sample_inchi_100.p", "wb"))
-    pickle.dump(sample_inchis_n2, file=open("Data/sample_inchi_1000.p", "wb"))
+    return sample_inchis
 
 
 def main():
     # ### Highest Degree compounds ###
     data_fp = "G:\\Shared drives\\SureChemBL_Patents\\Cpd_Data\\"
-    # # build_cpd_df(data_fp) #NOTE: only needs to be run once
 
-    cpd_df = pickle.load(file=open(data_fp + "SureChemBL_allCpds.p", "rb"))
-    print(cpd_df.columns)
+    #Columnar compound table & id/InChI/InChIKey indices
+    table_fp = data_fp + "SureChemBL_allCpds\\"
+    # build_cpd_df(data_fp) #NOTE: only needs to be run once
 
     # ### Statistics over highest degree compounds ###
     # n = 1000  #Number of compounds to find
     # for range in [(1980, 1984), (1985, 1989), (1990, 1994), (1995, 1999),
     #               (2000, 2004), (2005, 2009), (2010, 2014), (2015, 2019)]:
-    #     find_highest_degrees(cpd_df, n, range[0], range[1])
+    #     find_highest_degrees(table_fp, n, range[0], range[1])
+
+    # import get_cpd_network_data as cpd_network  #For build_increments()
+
+    # ### Top compounds of every window, by any metric ###
+    # for metric in ["degree", "attachment", "change"]:
+    #     top_df = top_k_by_window(
+    #         "G:\\Shared drives\\SureChemBL_Patents\\Degrees\\prefix_index_1962_2019.p",
+    #         cpd_network.build_increments(1980, 2019, 5), 1000, metric)
+    #     cpd_data = compound_store.lookup(table_fp, "SureChEMBL_ID",
+    #                                      top_df["SureChEMBL_ID"])
+    #     top_df = pd.concat([top_df, cpd_data.drop(columns="SureChEMBL_ID")],
+    #                        axis=1)
+    #     top_df.to_csv(data_fp + "top_" + metric + "_5yr.csv")
 
     # ### Testing Llanos et al (2019) compounds ###
-    # find_llanos_cpds(data_fp, cpd_df)
+    # find_llanos_cpds(data_fp, table_fp)
+
+    # ### Top attachment compounds most similar to a query compound ###
+    # index_fp = data_fp + "SureChemBL_fingerprints\\"
+    # fingerprint_index.build_fingerprint_index(table_fp, index_fp) #NOTE: only needs to be run once
+    # top_df = top_k_by_window(
+    #     "G:\\Shared drives\\SureChemBL_Patents\\Degrees\\prefix_index_1962_2019.p",
+    #     cpd_network.build_increments(2015, 2019, 5), 10000, "attachment")
+    # similar_df = find_similar_cpds(index_fp, table_fp,
+    #                                "InChI=1S/C7H6O/c8-6-7-4-2-1-3-5-7/h1-6H",
+    #                                top_df["SureChEMBL_ID"], k=100)
+
+    # ### Attachment percentiles of every compound, for every window ###
+    # percentile_df = window_percentile_columns(
+    #     "G:\\Shared drives\\SureChemBL_Patents\\Degrees\\prefix_index_1962_2019.p",
+    #     cpd_network.build_increments(1980, 2019, 5))
+    # pickle.dump(percentile_df,
+    #             file=open(data_fp + "attachment_percentiles_5yr.p", "wb"))
 
     ### Sampling compounds for MA analysis ###
-    month_unique_cpds = pickle.load(file=open(
-        "G:\\Shared drives\\SureChemBL_Patents\\CpdPatentIdsDates\\unique_cpds_AllMonths.p",
-        "rb"))
-    sample_compounds_unique(1000, build_month_increments(1980, 2019),
-                            month_unique_cpds, cpd_df)
-    # sample_compounds(100, 1000, build_month_increments(1980, 2019), cpd_df)
+    cpd_dates_fp = "G:\\Shared drives\\SureChemBL_Patents\\CpdPatentIdsDates\\"
+    #Compounds first added in each month (unique_cpds_AllMonths.p starts in 1962) -
+    # built once, then reused by every sample
+    if not os.path.isfile(cpd_dates_fp + "new_cpds_months.p"):
+        build_month_cpds(
+            pickle.load(
+                file=open(cpd_dates_fp + "unique_cpds_AllMonths.p", "rb")),
+            build_month_increments(1962, 2019), table_fp,
+            cpd_dates_fp + "new_cpds_months.p")
+    # #All compounds present in each month
+    # import month_pipeline
+    # months = build_month_increments(1980, 2019)
+    # build_month_cpds(
+    #     (cpds for _, cpds in month_pipeline.prefetch(
+    #         months, lambda month: month_pipeline.load_pickle(
+    #             cpd_dates_fp + "unique_cpds_" + month + ".p"))), months,
+    #     table_fp, cpd_dates_fp + "all_cpds_months.p")
+
+    sample_inchis = sample_compounds([1000], build_month_increments(1980, 2019),
+                                     cpd_dates_fp + "new_cpds_months.p",
+                                     table_fp)
+    pickle.dump(sample_inchis[1000],
+                file=open("Data/sample_inchi_1000_NEW.p", "wb"))
+    # sample_inchis = sample_compounds([100, 1000],
+    #                                  build_month_increments(1980, 2019),
+    #                                  cpd_dates_fp + "all_cpds_months.p",
+    #                                  table_fp)
+    # for size in [100, 1000]:
+    #     pickle.dump(sample_inchis[size],
+    #                 file=open("Data/sample_inchi_" + str(size) + ".p", "wb"))
 
     ### MA Analysis ###
 
@@ -0,0 +1,241 @@
+""" Memory-mapped storage of SureChemBL compound degree time series
+
+Stores monthly degrees, cumulative degrees, final degrees and preferential
+attachment values as flat arrays on disk, indexed by compound row. Runs over the
+full 1962-2019 range only ever hold one month (or one block of compounds) in
+memory, and analyses can page in only the compounds they query instead of
+unpickling a dictionary of every compound.
+
+Layout of a store directory:
+    meta.p            number of compounds, list of updates, id dtype
+    ids.dat           SureChemBL id of each row (fixed-width bytes)
+    ids_sorted.dat    ids in sorted order, for binary search lookups
+    id_order.dat      row of each entry in ids_sorted.dat
+    raw.dat           monthly degrees, (months x compounds) int32
+    cumulative.dat    cumulative degrees, (compounds x months) int32
+    final_degree.dat  last cumulative degree of each compound, int64
+    attachment.dat    preferential attachment index of each compound, float64
+
+"""
+
+import os
+import pickle
+import numpy as np
+
+#Default memory budget (in bytes) for a block of compounds
+DEFAULT_RAM_BUDGET = 4 * 1024**3
+
+
+def _shape(meta, name):
+    """ Finds the dtype and shape of a named store array
+
+    Args:
+        meta (dict): store metadata, from meta.p
+        name (string): name of the array
+
+    Returns:
+        tuple: (numpy dtype, shape tuple)
+    """
+    n, bins = meta["n"], len(meta["updates"])
+    shapes = {
+        "ids": (meta["id_dtype"], (n,)),
+        "ids_sorted": (meta["id_dtype"], (n,)),
+        "id_order": (np.int64, (n,)),
+        "raw": (np.int32, (bins, n)),
+        "cumulative": (np.int32, (n, bins)),
+        "final_degree": (np.int64, (n,)),
+        "attachment": (np.float64, (n,)),
+    }
+    return shapes[name]
+
+
+def open_array(fp, name, mode="r", meta=None):
+    """ Opens a single array of a degree store as a numpy memmap
+
+    Args:
+        fp (string): filepath to the store directory
+        name (string): name of the array (e.g. "cumulative", "attachment")
+        mode (string): memmap mode - "r" to read, "r+" to update, "w+" to create
+        meta (dict): store metadata (read from fp if not given)
+
+    Returns:
+        numpy memmap: the requested array
+    """
+    if meta is None:
+        meta = pickle.load(file=open(os.path.join(fp, "meta.p"), "rb"))
+    dtype, shape = _shape(meta, name)
+
+    return np.memmap(os.path.join(fp, name + ".dat"),
+                     dtype=dtype,
+                     mode=mode,
+                     shape=shape)
+
+
+def create_degree_store(fp, ids, updates):
+    """ Creates an empty degree store for a list of compounds and months
+
+    Args:
+        fp (string): filepath to the store directory (created if missing)
+        ids (list): SureChemBL id of each row
+        updates (list): list of all update months in format "YYYY-MM"
+
+    Returns:
+        dict: store metadata
+    """
+    os.makedirs(fp, exist_ok=True)
+
+    keys = np.asarray(ids, dtype=object).astype("S")
+    meta = {"n": len(keys), "updates": list(updates), "id_dtype": keys.dtype}
+    pickle.dump(meta, file=open(os.path.join(fp, "meta.p"), "wb"))
+
+    order = np.argsort(keys, kind="stable")
+    for name, values in [("ids", keys), ("ids_sorted", keys[order]),
+                         ("id_order", order)]:
+        array = open_array(fp, name, "w+", meta)
+        array[:] = values
+        array.flush()
+
+    #Allocate the monthly degree array (zero-filled on creation)
+    raw = open_array(fp, "raw", "w+", meta)
+    del (raw)
+
+    return meta
+
+
+def open_degree_store(fp):
+    """ Opens every array of a degree store read-only
+
+    Arrays are memory-mapped, so nothing is read from disk until it is indexed.
+
+    Args:
+        fp (string): filepath to the store directory
+
+    Returns:
+        dict: store metadata, plus a memmap for each array that exists on disk
+    """
+    meta = pickle.load(file=open(os.path.join(fp, "meta.p"), "rb"))
+    store = dict(meta)
+    store["fp"] = fp
+    for name in [
+            "ids", "ids_sorted", "id_order", "raw", "cumulative",
+            "final_degree", "attachment"
+    ]:
+        if os.path.isfile(os.path.join(fp, name + ".dat")):
+            store[name] = open_array(fp, name, "r", meta)
+
+    return store
+
+
+def lookup_rows(store, cpd_ids):
+    """ Finds the store row of each SureChemBL id with a binary search
+
+    Only the pages of the sorted id array touched by the search are read.
+
+    Args:
+        store (dict): opened store, from open_degree_store()
+        cpd_ids (list): SureChemBL ids to find
+
+    Returns:
+        numpy array: int64 row of each id (-1 if the id is not in the store)
+    """
+    keys = np.asarray(cpd_ids, dtype=object)
+    sorted_ids = store["ids_sorted"]
+    rows = np.full(len(keys), -1, dtype=np.int64)
+    if len(sorted_ids) == 0:
+        return rows
+
+    #Ids longer than the stored width would be truncated (and could match another id)
+    keys = keys.astype("S")
+    fits = np.char.str_len(keys) <= np.dtype(store["id_dtype"]).itemsize
+    keys = keys.astype(store["id_dtype"])
+
+    pos = np.searchsorted(sorted_ids, keys)
+    pos = np.minimum(pos, len(sorted_ids) - 1)
+    found = (sorted_ids[pos] == keys) & fits
+    rows[found] = store["id_order"][pos[found]]
+
+    return rows
+
+
+def load_compounds(fp, cpd_ids, names=("final_degree", "attachment")):
+    """ Pages in stored values for a list of compounds only
+
+    Args:
+        fp (string): filepath to the store directory
+        cpd_ids (list): SureChemBL ids to load
+        names (tuple): names of the arrays to load; "cumulative" loads the full
+            degree time series of each compound
+
+    Returns:
+        dict: "rows" plus one numpy array per name, in the order of cpd_ids (rows
+            of missing compounds are -1 and their values are zero/NaN)
+    """
+    store = open_degree_store(fp)
+    rows = lookup_rows(store, cpd_ids)
+    found = rows >= 0
+
+    data = {"rows": rows}
+    for name in names:
+        array = store[name]
+        values = np.zeros((len(rows),) + array.shape[1:], dtype=array.dtype)
+        if np.issubdtype(array.dtype, np.floating):
+            values[:] = np.nan
+
+        #Sorted row order keeps the reads sequential on disk
+        order = np.argsort(rows[found])
+        values[np.flatnonzero(found)[order]] = array[rows[found][order]]
+        data[name] = values
+
+    return data
+
+
+def row_blocks(n, bytes_per_row, ram_budget=DEFAULT_RAM_BUDGET):
+    """ Splits n rows into blocks which fit within a memory budget
+
+    Args:
+        n (int): total number of rows
+        bytes_per_row (int): memory needed to process a single row
+        ram_budget (int): memory budget in bytes
+
+    Returns:
+        list: list of (start, stop) row ranges
+    """
+    size = max(1, int(ram_budget // max(1, bytes_per_row)))
+    return [(start, min(start + size, n)) for start in range(0, n, size)]
+
+
+def cumulate_store(fp, ram_budget=DEFAULT_RAM_BUDGET):
+    """ Builds cumulative degrees, final degrees and attachment values from raw.dat
+
+    Processes blocks of compounds so that memory use is bounded by ram_budget,
+    regardless of the number of compounds or months. The attachment index is the
+    mean monthly increase of cumulative degree, mean(value[n+1] - value[n]), which
+    telescopes to (value[-1] - value[0]) / (months - 1).
+
+    Args:
+        fp (string): filepath to the store directory
+        ram_budget (int): memory budget in bytes
+    """
+    meta = pickle.load(file=open(os.path.join(fp, "meta.p"), "rb"))
+    n, bins = meta["n"], len(meta["updates"])
+
+    raw = open_array(fp, "raw", "r", meta)
+    cumulative = open_array(fp, "cumulative", "w+", meta)
+    final_degree = open_array(fp, "final_degree", "w+", meta)
+    attachment = open_array(fp, "attachment", "w+", meta)
+
+    #Block read, transposed copy, and cumulative sum of each row
+    for start, stop in row_blocks(n, bins * 4 * 3, ram_budget):
+        block = np.array(raw[:, start:stop])
+        np.cumsum(block, axis=0, out=block)
+
+        cumulative[start:stop] = block.T
+        final_degree[start:stop] = block[-1]
+        if bins > 1:
+            attachment[start:stop] = (block[-1] - block[0]) / (bins - 1)
+        else:
+            attachment[start:stop] = np.nan
+
+    cumulative.flush()
+    final_degree.flush()
+    attachment.flush()
@@ -0,0 +1,279 @@
+""" Bit-packed Morgan fingerprint index of the SureChemBL compound table
+
+Each compound table row (see compound_store.py) gets a Morgan fingerprint,
+packed 64 bits to a word into a memory-mapped (compounds x words) uint64 array,
+plus the number of set bits of each fingerprint. search() scores a query against
+the library with vectorized popcount Tanimoto similarity, over blocks of rows on
+several threads, and keeps the top k.
+
+With a similarity threshold, rows are prescreened by bit count first: the
+Tanimoto similarity of fingerprints with a and b bits set is at most
+min(a, b) / max(a, b), so most rows are skipped without reading their
+fingerprint.
+
+Layout of an index directory:
+    meta.p        number of rows, fingerprint bits and radius
+    fps.npy       packed fingerprints, (rows x bits / 64) uint64
+    counts.npy    set bits of each fingerprint, int16 (0 if the compound could
+                  not be parsed)
+
+"""
+
+import os
+import pickle
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from rdkit import Chem
+from rdkit import DataStructs
+from rdkit import RDLogger
+from rdkit.Chem import AllChem
+import compound_store
+
+RDLogger.DisableLog("rdApp.*")
+
+#Set bits of every byte value, for numpy versions without np.bitwise_count
+_BYTE_COUNTS = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def popcount(words):
+    """ Number of set bits in each row of a uint64 array
+
+    Args:
+        words (numpy array): (rows x words) uint64 array
+
+    Returns:
+        numpy array: int32 set bits of each row
+    """
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int32)
+    return _BYTE_COUNTS[words.view(np.uint8)].sum(axis=-1, dtype=np.int32)
+
+
+def fingerprint(mol, nbits=1024, radius=2):
+    """ Packed Morgan fingerprint of an rdkit molecule
+
+    Args:
+        mol (rdkit molecule): parsed compound (None gives an empty fingerprint)
+        nbits (int): fingerprint length in bits (a multiple of 64)
+        radius (int): Morgan radius
+
+    Returns:
+        numpy array: (nbits / 64) uint64 words
+    """
+    bits = np.zeros(nbits, dtype=np.uint8)
+    if mol is not None:
+        DataStructs.ConvertToNumpyArray(
+            AllChem.GetMorganFingerprintAsBitVect(mol, radius, nBits=nbits),
+            bits)
+    return np.packbits(bits).view(np.uint64)
+
+
+def parse(smiles, inchi):
+    """ Parses a compound from its SMILES (or InChI if the SMILES fails)
+
+    Returns:
+        rdkit molecule (None if neither can be parsed)
+    """
+    mol = None
+    try:
+        mol = Chem.MolFromSmiles(smiles) if smiles else None
+        if mol is None and inchi:
+            mol = Chem.MolFromInchi(inchi)
+    except Exception:
+        pass
+    return mol
+
+
+def _fingerprint_block(args):
+    """ Fingerprints a block of compound table rows into the index (run in a worker) """
+    table_fp, fp, start, stop = args
+    meta = pickle.load(file=open(os.path.join(fp, "meta.p"), "rb"))
+    table = compound_store.open_table(table_fp)
+    smiles = compound_store.read_column(table, "SMILES", slice(start, stop))
+    inchis = compound_store.read_column(table, "InChI", slice(start, stop))
+
+    block = np.zeros((stop - start, meta["nbits"] // 64), dtype=np.uint64)
+    for i, (s, inchi) in enumerate(zip(smiles, inchis)):
+        block[i] = fingerprint(parse(s, inchi), meta["nbits"], meta["radius"])
+
+    fps = np.load(os.path.join(fp, "fps.npy"), mmap_mode="r+")
+    counts = np.load(os.path.join(fp, "counts.npy"), mmap_mode="r+")
+    fps[start:stop] = block
+    counts[start:stop] = popcount(block)
+    fps.flush()
+    counts.flush()
+
+
+def build_fingerprint_index(table_fp,
+                            fp,
+                            nbits=1024,
+                            radius=2,
+                            processes=None,
+                            block_rows=100000):
+    """ Builds the fingerprint index of every compound in the compound table
+
+    Args:
+        table_fp (string): filepath to the SureChemBL compound table (see compound_store.py)
+        fp (string): filepath to the index directory (created if missing)
+        nbits (int): fingerprint length in bits (a multiple of 64)
+        radius (int): Morgan radius
+        processes (int): number of worker processes (default: number of cores)
+        block_rows (int): number of rows fingerprinted by a worker at once
+    """
+    os.makedirs(fp, exist_ok=True)
+    n = compound_store.open_table(table_fp)["n"]
+    pickle.dump({
+        "n": n,
+        "nbits": nbits,
+        "radius": radius
+    },
+                file=open(os.path.join(fp, "meta.p"), "wb"))
+
+    #Allocate the index, then fill blocks of rows in parallel
+    fps = np.lib.format.open_memmap(os.path.join(fp, "fps.npy"),
+                                    mode="w+",
+                                    dtype=np.uint64,
+                                    shape=(n, nbits // 64))
+    counts = np.lib.format.open_memmap(os.path.join(fp, "counts.npy"),
+                                       mode="w+",
+                                       dtype=np.int16,
+                                       shape=(n,))
+    del (fps)
+    del (counts)
+
+    blocks = [(table_fp, fp, start, min(start + block_rows, n))
+              for start in range(0, n, block_rows)]
+    pool = mp.Pool(processes)
+    for i, _ in enumerate(pool.imap_unordered(_fingerprint_block, blocks)):
+        print("-- Fingerprinted block", i + 1, "of", len(blocks), "--")
+    pool.close()
+    pool.join()
+
+
+def open_fingerprint_index(fp):
+    """ Opens a fingerprint index (memory-mapped, nothing is read until searched)
+
+    Args:
+        fp (string): filepath to the index directory
+
+    Returns:
+        dict: index metadata, plus "fps" and "counts" memmaps
+    """
+    index = pickle.load(file=open(os.path.join(fp, "meta.p"), "rb"))
+    index["fps"] = np.load(os.path.join(fp, "fps.npy"), mmap_mode="r")
+    index["counts"] = np.load(os.path.join(fp, "counts.npy"), mmap_mode="r")
+    return index
+
+
+def _search_block(index, query, query_count, rows, k, threshold):
+    """ Top k rows (and similarities) of one block of distinct, sorted candidate rows
+
+    Rows without a fingerprint (compounds which could not be parsed) are never
+    returned.
+    """
+    if threshold > 0:
+        #Count-based bound on Tanimoto similarity
+        bits = index["counts"][rows].astype(np.float64)
+        bound = np.minimum(bits, query_count) / np.maximum(
+            np.maximum(bits, query_count), 1)
+        candidates = (bound >= threshold) & (bits > 0)
+        #Only gather rows if the prescreen removes most of them
+        if candidates.mean() < 0.5:
+            rows = rows[candidates]
+    if len(rows) == 0:
+        return rows, np.zeros(0)
+
+    if rows[-1] - rows[0] + 1 == len(rows):
+        #Contiguous rows - a single sequential read
+        fps = index["fps"][rows[0]:rows[-1] + 1]
+        counts = index["counts"][rows[0]:rows[-1] + 1]
+    else:
+        fps = index["fps"][rows]
+        counts = index["counts"][rows]
+    common = popcount(fps & query)
+    union = counts.astype(np.int32) + query_count - common
+    similarity = common / np.maximum(union, 1)
+
+    keep = (similarity >= threshold) & (counts > 0)
+    rows, similarity = rows[keep], similarity[keep]
+    if len(rows) > k:
+        top = np.argpartition(-similarity, k - 1)[:k]
+        rows, similarity = rows[top], similarity[top]
+    return rows, similarity
+
+
+def search(index,
+           query,
+           k=100,
+           threshold=0,
+           rows=None,
+           workers=None,
+           block_rows=65536):
+    """ Finds the k compounds most similar (Tanimoto) to a query fingerprint
+
+    Args:
+        index (dict): opened index, from open_fingerprint_index()
+        query (numpy array): packed query fingerprint, from fingerprint()
+        k (int): number of compounds to return
+        threshold (float): minimum similarity - above 0, rows are prescreened by
+            bit count before their fingerprints are read
+        rows (array-like): compound table rows to search (default: all rows), e.g.
+            the rows of high-attachment compounds - repeated rows are searched once
+        workers (int): number of search threads (default: number of cores)
+        block_rows (int): number of rows scored at once by a thread
+
+    Returns:
+        tuple: (int64 compound table rows, float64 similarities), most similar first
+    """
+    query = np.asarray(query, dtype=np.uint64)
+    query_count = int(popcount(query))
+    if rows is None:
+        rows = np.arange(index["n"], dtype=np.int64)
+    rows = np.unique(np.asarray(rows, dtype=np.int64))
+
+    blocks = [rows[i:i + block_rows] for i in range(0, len(rows), block_rows)]
+    with ThreadPoolExecutor(workers or mp.cpu_count()) as pool:
+        results = list(
+            pool.map(
+                lambda block: _search_block(index, query, query_count, block,
+                                            k, threshold), blocks))
+
+    #Merge the top k of every block
+    found = np.concatenate([np.zeros(0, np.int64)] + [r for r, _ in results])
+    similarity = np.concatenate([np.zeros(0)] + [s for _, s in results])
+    order = np.lexsort((found, -similarity))[:k]
+
+    return found[order], similarity[order]
+
+
+def similar_compounds(index_fp, table_fp, smiles=None, inchi=None, **kwargs):
+    """ Finds the compounds most similar to a query compound, with their table data
+
+    Args:
+        index_fp (string): filepath to the fingerprint index
+        table_fp (string): filepath to the SureChemBL compound table (see compound_store.py)
+        smiles (string): query SMILES
+        inchi (string): query InChI (used if no SMILES is given)
+        **kwargs: search() options (k, threshold, rows, workers)
+
+    Raises:
+        ValueError: if the query compound cannot be parsed
+
+    Returns:
+        pandas dataframe: row, similarity and table columns of each match, most
+            similar first
+    """
+    mol = parse(smiles, inchi)
+    if mol is None:
+        raise ValueError("Query compound could not be parsed: " +
+                         str(smiles or inchi))
+
+    index = open_fingerprint_index(index_fp)
+    query = fingerprint(mol, index["nbits"], index["radius"])
+    rows, similarity = search(index, query, **kwargs)
+
+    df = compound_store.read_table(table_fp, rows=rows)
+    df.insert(0, "similarity", similarity)
+    df.insert(0, "row", rows)
+    return df
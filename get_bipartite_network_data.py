@@ -6,6 +6,7 @@ import pandas as pd
 from itertools import islice
 import time
 import subprocess
+import month_pipeline
 
 
 def build_month_list(start, end):
@@ -29,117 +30,139 @@ def build_month_list(start, end):
     return updates
 
 
-def build_master_cpd_date(updates):
-    """ Link compunds with the month it was first found
+#First month of compounds which never appear in the event data
+NEVER = np.iinfo(np.int32).max
 
-    Args:
-        updates (list): list of all months in a certain range
-    """
-    fp = "G:/Shared drives/SureChemBL_Patents/"
-
-    master_cpd_date_dict = {}
-
-    #Find all compounds belonging to a specific month
-    for update in tqdm(updates):
-        cpd_date_dict = pickle.load(
-            file=open(fp + "CpdPatentIdsDates/cpd_date_dict_" + update +
-                      ".p", "rb"))
 
-        for cpd in cpd_date_dict.keys():
-            #If that compound was not present before, add it to the master dictionary
-            if cpd not in master_cpd_date_dict:
-                master_cpd_date_dict[cpd] = update
+def build_first_month_index(updates, fp, id_dict="cpd_ID_index_dict.p"):
+    """ Builds an array of the first month each compound appears in
 
-    pickle.dump(master_cpd_date_dict,
-                file=open(fp + "Cpd_Data/master_cpd_date_dict.p", "wb"))
-
-    #Save this dictionary as a dataframe for later analysis
-    df = pd.DataFrame(master_cpd_date_dict.items(), columns=["Cpd", "Month"])
-    pickle.dump(df, file=open(fp + "Cpd_Data/master_cpd_date_df.p", "wb"))
+    The array is indexed by igraph compound index (see cpd_ID_index_dict.p) and
+    holds the position of the compound's first month in updates (NEVER if the
+    compound never appears). It is a grouped minimum of month position over all
+    (compound, month) events, with each month's compounds mapped to indices in
+    one vectorized lookup - so with parent-level indices (see
+    build_network.build_cpd_ID_mapping()), a parent's first month is the earliest
+    of its members.
 
+    Args:
+        updates (list): list of all months in a certain range, in order
+        fp (string): filepath to Google Drive information
+        id_dict (string): compound index dictionary in /Cpd_Data (e.g.
+            "cpd_parent_index_dict.p" for parent-level compounds)
 
-def link_ids_cpds(fp):
-    """ Links all compound SureChemBL Ids to index numbers in igraph network
+    Returns:
+        None, writes the first-month index to /Cpd_Data/first_month_index.p in GDrive
+    """
+    cpd_ID_index_dict = pickle.load(file=open(fp + "Cpd_Data/" + id_dict, "rb"))
+    id_index = pd.Index(list(cpd_ID_index_dict.keys()))
+    id_values = np.fromiter(cpd_ID_index_dict.values(), dtype=np.int64)
+    del (cpd_ID_index_dict)
+
+    first = np.full(id_values.max() + 1 if len(id_values) else 0,
+                    NEVER,
+                    dtype=np.int32)
+
+    #Find all compounds belonging to a specific month (loading ahead in the background)
+    months = month_pipeline.prefetch(
+        updates, lambda update: month_pipeline.load_pickle_if_exists(
+            fp + "CpdPatentIdsDates/cpd_date_dict_" + update + ".p"))
+    for position, (update, cpd_date_dict) in enumerate(
+            tqdm(months, total=len(updates))):
+        if cpd_date_dict is None:
+            continue
+        positions = id_index.get_indexer(list(cpd_date_dict.keys()))
+        indices = id_values[positions[positions >= 0]]
+        #np.minimum.at, as several compounds may share a parent index
+        np.minimum.at(first, indices, position)
+
+    pickle.dump({
+        "updates": list(updates),
+        "first": first
+    },
+                file=open(fp + "Cpd_Data/first_month_index.p", "wb"))
+
+
+def month_position(index, month):
+    """ Position of a month in a first-month index (months before the first update
+    are -1, months after the last update are the last position)
 
     Args:
-        fp (string): filepath to Google Drive information
+        index (dict): first-month index, from build_first_month_index()
+        month (string): month in the form YYYY-MM
 
     Returns:
-        None, writes a master dataframe containing SureChemBL cpd ids, dates, and indicies to
-        /Cpd_Data in GDrive
+        int: position of the latest update on or before month
     """
-    cpd_date_df = pickle.load(file=open(fp + "master_cpd_date_df.p", "rb"))
-    cpd_ID_index_dict = pickle.load(file=open(fp + "cpd_ID_index_dict.p", "rb"))
+    return int(np.searchsorted(index["updates"], month, side="right")) - 1
 
-    indicies = []
-    for index, row in tqdm(cpd_date_df.iterrows(), total=cpd_date_df.shape[0]):
-        try:
-            indicies.append(cpd_ID_index_dict[row["Cpd"]])
-        except:
-            indicies.append(-1)
 
-    cpd_date_df["Index"] = indicies
-    pickle.dump(cpd_date_df, file=open(fp + "master_cpd_date_index_df.p", "wb"))
+def new_in_month(index, month):
+    """ igraph indices of compounds which first appear in a given month """
+    position = month_position(index, month)
+    if position < 0 or index["updates"][position] != month:
+        return np.zeros(0, dtype=np.int64)
+    return np.flatnonzero(index["first"] == position)
 
 
-def check_indicies(df):
-    """ Checks how many dataframe entries have no index in bipartite network
+def new_in_window(index, start, stop):
+    """ igraph indices of compounds which first appear between two months (inclusive) """
+    return np.flatnonzero((index["first"] >= month_position(index, start)) &
+                          (index["first"] <= month_position(index, stop)))
 
-    Only 300k have none (1.59%, that's fine)
 
-    Args:
-        df (pandas dataframe): master compound-date-index dataframe
-    """
-    print("Number of cpds:", len(df))
-    print("Number of cpds with no index:", len(df[df["Index"] == -1]))
+def present_by(index, month):
+    """ igraph indices of compounds which appear on or before a given month """
+    return np.flatnonzero(index["first"] <= month_position(index, month))
 
 
-def get_earlier_cpds(month):
+def get_earlier_cpds(month, index=None):
     """ Finds all compounds which were inputted into SureChemBL prior to or equal
     to a given month
 
     Args:
         month (string): Month, in the form YYYY-MM
+        index (dict): first-month index (read from Data/Cpd_Data/ if not given)
 
     Returns:
-        pandas dataframe: dataframe containing SureChemBL patent id, month of
-        first entry, and igraph index
+        numpy array: igraph indices of all compounds present by that month
     """
-    #Read in master compound-date-index dataframe
-    agave_fp = "Data/Cpd_Data/master_cpd_date_index_df.p"
-    #drive_fp = "G:/Shared drives/SureChemBL_Patents/Cpd_Data/master_cpd_date_index_df.p"
-    df = pickle.load(file=open(agave_fp, "rb"))
+    if index is None:
+        #drive_fp = "G:/Shared drives/SureChemBL_Patents/Cpd_Data/first_month_index.p"
+        index = pickle.load(
+            file=open("Data/Cpd_Data/first_month_index.p", "rb"))
 
-    # #Small dataframe analysis
-    # check_indicies(df)
+    return present_by(index, month)
 
-    return df[df["Month"] <= month]
 
-
-def build_subgraph(G, month):
+def build_subgraph(G, month, index=None):
     """ Builds a cpd-patent bipartite subgraph containing only compounds present
     before or in a given month
 
     Args:
         G (igraph network): full cpd-patent igraph network
         month (string): month
+        index (dict): first-month index (see get_earlier_cpds()) - must be built
+            from the same compound index dictionary as G
 
     Returns:
         None, saves each subgraph to /scratch
     """
+    if index is None:
+        index = pickle.load(
+            file=open("Data/Cpd_Data/first_month_index.p", "rb"))
+
     #Find all compounds before the given month
-    df = get_earlier_cpds(month)
+    cpds = get_earlier_cpds(month, index)
 
     #Build subgraph from full igraph subgraph (G.subgraph, include only relevant
-    # cpd indicies and ALL PATENTS (to avoid cpd-cpd edges))
-    num_cpds = 21641384  #Numbers from cpd/patent id dicts used to build igraph network
-    num_patents = 4578946
+    # cpd indicies and ALL PATENTS (to avoid cpd-cpd edges)) - compound vertices
+    # come first, then patents (also with parent compounds or merged patents)
+    num_cpds = len(index["first"])
 
     #Index list of all compounds present in earlier dates, including all patents
-    indicies = df["Index"].tolist() + list(
-        np.arange(num_cpds, num_cpds + num_patents, 1))
-    #Remove all -1s, not entirely sure what's going on with these
-    indicies = [x for x in indicies if x != -1]
+    indicies = np.concatenate(
+        [cpds, np.arange(num_cpds, G.vcount(), 1)]).tolist()
 
     G_sub = G.subgraph(indicies)
     print(ig.summary(G_sub))
@@ -298,6 +321,108 @@ def get_network_stats(G, month):
               month + ".csv")
 
 
+def grow(array, size):
+    """ Pads a 1D numpy array with zeros so that it holds at least size entries
+
+    Args:
+        array (numpy array): array to pad
+        size (int): minimum length
+
+    Returns:
+        numpy array: original array if already long enough, otherwise a zero-padded copy
+    """
+    if len(array) >= size:
+        return array
+    return np.concatenate([array, np.zeros(size - len(array), dtype=array.dtype)])
+
+
+def attachment_kernel(updates, fp):
+    """ Estimates the preferential attachment kernel A(k) of compounds over time
+
+    Streams the monthly patent-cpd edges (patent_id_edges<update>.p) in time order.
+    For each new edge, the degree k of its compound at the start of that month is
+    recorded, and normalized by the number of edges expected to reach degree-k
+    compounds if attachment were uniform over all existing compounds (see Jeong et
+    al 2003, Newman 2001). A(k) = 1 means no preference, A(k) ~ k is linear
+    preferential attachment. Edges to compounds first seen that month are node
+    arrivals, not attachments, and are counted separately.
+
+    Histograms grow with the largest degree seen; the only per-compound state is a
+    single int32 degree array indexed by compound index.
+
+    Args:
+        updates (list): list of months (YYYY-MM format), in time order
+        fp (string): filepath to CpdPatentIdsDates directory
+
+    Returns:
+        pandas dataframe: "degree", "attachments" (observed edges), "expected"
+            (edges under uniform attachment), and "kernel" (attachments / expected)
+    """
+    cpd_degrees = np.zeros(0, dtype=np.int32)
+    degree_hist = np.zeros(1, dtype=np.int64)  #number of compounds with degree k
+    observed = np.zeros(1, dtype=np.int64)
+    expected = np.zeros(1, dtype=np.float64)
+    arrivals = 0
+
+    months = month_pipeline.prefetch(
+        updates, lambda update: month_pipeline.load_pickle_if_exists(
+            fp + "patent_id_edges" + update + ".p"))
+    for update, patent_index_edges in tqdm(months, total=len(updates)):
+        #Skip months without a patent_id_edges file
+        if patent_index_edges is None:
+            continue
+
+        cpd_lists = [cpds for cpds in patent_index_edges.values() if cpds]
+        if not cpd_lists:
+            continue
+        targets = np.concatenate(cpd_lists).astype(np.int64)
+        cpd_degrees = grow(cpd_degrees, targets.max() + 1)
+
+        #Degree of each target at the start of the month
+        k = cpd_degrees[targets]
+        existing = k > 0
+        arrivals += int((~existing).sum())
+
+        num_existing = degree_hist[1:].sum()
+        if num_existing > 0 and existing.any():
+            counts = np.bincount(k[existing])
+            observed = grow(observed, len(counts))
+            observed[:len(counts)] += counts
+
+            #Edges each degree class would receive under uniform attachment
+            expected = grow(expected, len(degree_hist))
+            expected[:len(degree_hist)] += (existing.sum() * degree_hist /
+                                            num_existing)
+
+        #Update compound degrees and the degree histogram
+        cpds, increments = np.unique(targets, return_counts=True)
+        old = cpd_degrees[cpds]
+        new = old + increments
+        cpd_degrees[cpds] = new
+
+        old_counts = np.bincount(old[old > 0])
+        new_counts = np.bincount(new)
+        degree_hist = grow(degree_hist, len(new_counts))
+        degree_hist[:len(old_counts)] -= old_counts
+        degree_hist[:len(new_counts)] += new_counts
+        degree_hist[0] = 0
+
+    print("Compound arrivals (excluded from kernel):", arrivals)
+
+    size = max(len(observed), len(expected))
+    observed = grow(observed, size)
+    expected = grow(expected, size)
+    df = pd.DataFrame({
+        "degree": np.arange(size),
+        "attachments": observed,
+        "expected": expected
+    })
+    df = df[df["expected"] > 0]
+    df["kernel"] = df["attachments"] / df["expected"]
+
+    return df.reset_index(drop=True)
+
+
 def main():
     updates = build_month_list(1991, 2020)
 
@@ -306,19 +431,22 @@ def main():
     #1: Build subgraphs of patents/compounds present before a specific date
 
     #1a: Link date of first entry & index of compounds
-    #build_master_cpd_date(updates) #NOTE: should only be run once
-    #link_ids_cpds("G:/Shared drives/SureChemBL_Patents/Cpd_Data/") #NOTE: should only be run once
+    #build_first_month_index(build_month_list(1962, 2020), "G:/Shared drives/SureChemBL_Patents/") #NOTE: should only be run once
+    index = pickle.load(file=open("Data/Cpd_Data/first_month_index.p", "rb"))
 
     G = pickle.load(file=open("/scratch/jmalloy3/Patents/cpd_patent_G.p", "rb"))
     print(ig.summary(G))
 
     for month in updates:
-        G_sub = build_subgraph(G, month)
+        G_sub = build_subgraph(G, month, index)
 
         #2: Network stats over these subgraphs (not immediately necessary)
         get_network_stats(G_sub, month)
 
     #3: Preferential attachement over compounds
+    # kernel_df = attachment_kernel(build_month_list(1962, 2019),
+    #                               "Data/CpdPatentIdsDates/")
+    # kernel_df.to_csv("Data/attachment_kernel_1962_2019.csv")
 
     #4: Track compounds over time
 
@@ -11,10 +11,12 @@ import numpy as np
 import pickle
 from itertools import islice
 from itertools import zip_longest
-from itertools import accumulate
 import os
-import subprocess
 import pandas as pd
+from scipy import sparse
+import degree_store
+import storage
+import month_pipeline
 
 
 def get_degrees(G):
@@ -43,21 +45,19 @@ def get_id_degree(G):
     return id_degree_dict
 
 
-def read_cpdcpd_graph(update):
-    """ Reads a cpd-cpd graph in .gmlz format
+def read_cpdcpd_graph(update, fp):
+    """ Reads a cpd-cpd graph in .p format
 
-    Takes a stored igraph network in .gmlz format and reads it into igraph form.
-    Assumes that the data are stored in the /scratch/jmalloy3/Graphs/ directory and in the format
-    G_cpd_<update>.gmlz.
+    Takes a stored igraph network in pickled form and reads it into igraph form.
+    Graphs are stored under the Graphs/G_cpd_<update>.p key (see storage.py).
 
     Args:
-        fp (string): filepath to a specific cpd-cpd graph
+        update (string): month of the graph, YYYY-MM
+        fp (string): local filepath to a specific cpd-cpd graph
 
     Returns:
         G (igraph object): cpd-cpd network pertaining to a specific update
     """
-    fp = "/scratch/jmalloy3/Graphs/G_cpd_" + update + ".p"
-    #fp = "G:\\Shared drives\\SureChemBL_Patents\\Graphs\\G_cpd_" + update + ".p"
     print(fp)
     G = pickle.load(open(fp, "rb"))
     print("Loaded graph:", update)
@@ -90,15 +90,20 @@ def get_network_stats(start, stop):
     updates = build_month_list(start, stop)
     data = []
 
-    for update in updates:
-        subprocess.run([
-            "rclone",
-            "copy",
-            "SureChemBL_Patents:Graphs/G_cpd_" + update + ".p",
-            "/scratch/jmalloy3/Graphs/",
-        ])
+    remote = storage.RemoteStorage()
+    scratch = storage.LocalStorage(storage.SCRATCH)
+    writer = month_pipeline.AsyncWriter()
 
-        G = read_cpdcpd_graph(update)
+    def load_graph(update):
+        return read_cpdcpd_graph(
+            update,
+            remote.fetch(["Graphs/G_cpd_" + update + ".p"])[0])
+
+    #Graphs are ~4 GB each, so only the next month is loaded ahead
+    for update, G in month_pipeline.prefetch(updates,
+                                             load_graph,
+                                             depth=1,
+                                             workers=1):
         network_stats = {}
 
         degrees = get_degrees(G)
@@ -114,21 +119,16 @@ def get_network_stats(start, stop):
         print()
         data.append(network_stats)
 
-        pickle.dump(degrees,
-                    file=open(
-                        "/scratch/jmalloy3/Degrees/Months/degrees_" + update +
-                        ".p", "wb"))
-
-        pickle.dump(id_degrees,
-                    file=open(
-                        "/scratch/jmalloy3/Degrees/Months/id_degrees_" +
-                        update + ".p", "wb"))
+        writer.submit(scratch.dump, degrees,
+                      "Degrees/Months/degrees_" + update + ".p")
+        writer.submit(scratch.dump, id_degrees,
+                      "Degrees/Months/id_degrees_" + update + ".p")
+        del (G)
 
+    writer.close()
     df = pd.DataFrame(data)
-    pickle.dump(df,
-                file=open(
-                    "/scratch/jmalloy3/NetworkStats/stats_" + str(start) + "_" +
-                    str(stop) + ".p", "wb"))
+    scratch.dump(df,
+                 "NetworkStats/stats_" + str(start) + "_" + str(stop) + ".p")
 
 
 def build_month_list(start, end):
@@ -180,151 +180,330 @@ def get_degree_distributions():
     pickle.dump(avg, file=open("Data/Degrees/avg_degree_list.p", "wb"))
 
 
-def link_id_degrees(full_id_degrees, id_degrees, i, bins):
-    """ Puts the ids of specific updates/times into a full dictionary of id-[degrees]
+def link_id_degrees(id_degrees, i):
+    """ Converts the ids & degrees of a specific update into matrix entries
 
-    Takes in a specific update (id_degrees), and adds the degrees present in that
-    update to the full id:degree dictionary. The degrees are a list of len(bins),
-    and each item is the sum of the previous item and the total provided in id_degrees.
+    Takes in a specific update (id_degrees) and returns the SureChemBL ids, column
+    (update) positions, and degrees as flat arrays. Entries from all updates are
+    later combined into a single compound x month matrix by build_degree_matrix().
 
     Args:
-        full_id_degrees (dictionary): links a SureChemBL id with a list of degrees
-            over time. The degrees are added together as they increase.
         id_degrees (dictionary): links a SureChemBL id with a specific degree from
             a specific update.
-        i (int): the increment of the specific update, provides the necessary place
-            for the full_id_degrees dictionary
-        bins (int): number of updates
+        i (int): the increment of the specific update, provides the necessary column
+            for the compound x month matrix
 
     Returns:
-        full_id_degrees: updated full dictionary of id:[degrees]
+        ids (numpy array): SureChemBL ids present in the update
+        cols (numpy array): column index (i) of each entry
+        values (numpy array): degree of each id in the update
     """
-    for key, value in id_degrees.items():
-        #If a id is in the dictionary, update the appropriate degree value
-        if key in full_id_degrees:
-            full_id_degrees[key][i] = value
-        # If a id is not in the dictionary, add it with a list of len(updates) 0s and update the appropriate degree value
-        else:
-            full_id_degrees[key] = [0] * bins
-            full_id_degrees[key][i] = value
+    ids = np.array(list(id_degrees.keys()), dtype=object)
+    values = np.fromiter(id_degrees.values(),
+                         dtype=np.int32,
+                         count=len(id_degrees))
+    cols = np.full(len(ids), i, dtype=np.int32)
 
-    return full_id_degrees
+    return ids, cols, values
 
 
-def replace_zeroes(full_id_degrees):
-    """Replaces all zero values using itertools.accumulate()
+def build_degree_matrix(entries, bins):
+    """ Builds a sparse compound x month degree matrix from per-update entries
 
-    Takea the full dictionary of id:[degree], then finds the cumulative sum
-    across the entire list of degrees and replaces the original degree list with
-    this cumulative list (for preferential attachment purposes)
+    Every SureChemBL id is given a row (in order of first appearance), and every
+    update is a column. Degrees are stored as raw (non-cumulative) monthly values.
 
     Args:
-        full_id_degrees (dictionary): links a SureChemBL id with a list of degrees
-            over time. The degrees are added together as they increase
+        entries (list): list of (ids, cols, values) tuples from link_id_degrees()
+        bins (int): number of updates
 
     Returns:
-        full_id_degrees: full dictionary with cumulative sums as degree list
+        ids (numpy array): SureChemBL id of each matrix row
+        degrees (scipy csr_matrix): int32 matrix of monthly degrees, shape (len(ids), bins)
     """
-    #Finds cumulative sum of values
-    print("\n----- Replacing zero values -----\n")
-    for key, value in full_id_degrees.items():
-        cum_value = list(accumulate(value))
-        full_id_degrees[key] = cum_value
+    if not entries:
+        return np.array([], dtype=object), sparse.csr_matrix((0, bins),
+                                                             dtype=np.int32)
+
+    all_ids = np.concatenate([e[0] for e in entries])
+    cols = np.concatenate([e[1] for e in entries])
+    values = np.concatenate([e[2] for e in entries])
 
-    return full_id_degrees
+    #Factorize once over all updates instead of a dictionary lookup per id
+    rows, ids = pd.factorize(all_ids)
+    degrees = sparse.csr_matrix((values, (rows, cols)),
+                                shape=(len(ids), bins),
+                                dtype=np.int32)
 
+    return np.asarray(ids, dtype=object), degrees
 
-def pref_attachment_calculation(full_id_degrees):
-    """ Calculates preferential attachment over a list of degrees
 
-    Given a list of increasing degrees associated with each SureChemBL id, the
-    preferential attachment index sum(value[n+1] - value[n]), over all n is calculated
+def fetch_id_degrees(remote, updates, batch=12):
+    """ Yields local filepaths of id_degrees_* files, fetching a batch of months at a time
 
     Args:
-        full_id_degrees (dictionary): links a SureChemBL id with a list of degrees
-            over time. The degrees are added together as they increase
+        remote (RemoteStorage): storage holding Degrees/Months
+        updates (list): list of all update months in format "YYYY-MM"
+        batch (int): number of months to transfer together
+
+    Yields:
+        string: local filepath of each update's id_degrees file, in order
+    """
+    for i in range(0, len(updates), batch):
+        keys = [
+            "Degrees/Months/id_degrees_" + update + ".p"
+            for update in updates[i:i + batch]
+        ]
+        for fp in remote.fetch(keys):
+            yield fp
+
+
+def load_degree_matrix(updates, remote=None):
+    """ Loads the id_degrees_* file of every update into a compound x month matrix
+
+    Args:
+        updates (list): list of all update months in format "YYYY-MM"
+        remote (RemoteStorage): storage holding Degrees/Months (default: GDrive remote)
 
     Returns:
-        pref_attach_dict: associated a preferential attachment index with each
-            SureChemBL ID
+        ids (numpy array): SureChemBL id of each matrix row
+        degrees (scipy csr_matrix): int32 matrix of monthly degrees, shape (len(ids), len(updates))
     """
+    if remote is None:
+        remote = storage.RemoteStorage()
+    entries = []
 
-    print("\n----- Calculating preferential attachment -----\n")
-    pref_attach_dict = {}
-    for key, value in full_id_degrees.items():
-        c = 0
-        attachments = []
-        while c < len(value) - 1:
-            attachments.append(value[c + 1] - value[c])
-            c += 1
-        pref_attach_dict[key] = np.mean(attachments)
+    #Load id_degree dictionaries in the background
+    months = month_pipeline.prefetch(fetch_id_degrees(remote, updates),
+                                     month_pipeline.load_pickle,
+                                     depth=4)
+    for i, (_, id_degrees) in enumerate(months):
+        entries.append(link_id_degrees(id_degrees, i))
 
-    return pref_attach_dict
+    return build_degree_matrix(entries, len(updates))
 
 
-def calculate_preferential_attachment(start, stop):
+def calculate_preferential_attachment(start,
+                                      stop,
+                                      cpd_index_fp="Data/cpd_ID_index_dict.p",
+                                      ram_budget=degree_store.DEFAULT_RAM_BUDGET,
+                                      remote=None):
     """ Calculates preferential attachment index (see Rednar 2004) for SureChemBL degrees
     across all patents
 
-    Uses data stored in the 'Data/Degrees/id_degrees_*' files to build a preferential
-    attachment index. Saves both the full list of id:degree pairs (summed over time)
-    and the preferential attachment indicies of each degree to pickle files in
-    'Data/Degrees' directory
+    Uses data stored in the 'Degrees/Months/id_degrees_*' files to build an on-disk degree
+    store (see degree_store.py), with one row per compound in the compound-index
+    dictionary. Monthly degrees are written one month at a time, then cumulative degrees,
+    final degrees and preferential attachment indicies are computed over blocks of
+    compounds, so memory use stays within ram_budget for any range of years.
+
+    Args:
+        start (int): year of starting point for analysis
+        stop (int): year of ending point (inclusive)
+        cpd_index_fp (string): filepath to the SureChemBL id:index dictionary (one
+            index per compound - parent-level dictionaries are rejected)
+        ram_budget (int): memory budget (in bytes) for each block of compounds
+        remote (RemoteStorage): storage holding Degrees/Months (default: GDrive remote)
     """
-    print("\n----- Building id-degree dictionary -----\n")
+    print("\n----- Building id-degree store -----\n")
     updates = build_month_list(start, stop)
 
-    full_id_degrees = {}
-    bins = len(updates)
+    #Row of each compound is its index in the bipartite network
+    cpd_id_dict = pickle.load(file=open(cpd_index_fp, "rb"))
+    values = np.fromiter(cpd_id_dict.values(),
+                         dtype=np.int64,
+                         count=len(cpd_id_dict))
+    #Monthly degrees are per SureChemBL id, so each id needs its own row
+    if len(np.unique(values)) != len(values) or (len(values) and
+                                                  values.max() >= len(values)):
+        raise ValueError(cpd_index_fp + " does not give each compound its own " +
+                         "index (a parent-level dictionary?) - use cpd_ID_index_dict.p")
+    ids = np.empty(len(cpd_id_dict), dtype=object)
+    ids[values] = list(cpd_id_dict.keys())
+    del (cpd_id_dict)
+    id_index = pd.Index(ids)
+
+    fp = storage.SCRATCH + "Degrees/full_id_degrees_" + str(start) + "_" + str(
+        stop)
+    meta = degree_store.create_degree_store(fp, ids, updates)
+    raw = degree_store.open_array(fp, "raw", "r+", meta)
+
+    if remote is None:
+        remote = storage.RemoteStorage()
+
+    missing = 0
+    #Load id_degree dictionaries in the background
+    months = month_pipeline.prefetch(fetch_id_degrees(remote, updates),
+                                     month_pipeline.load_pickle,
+                                     depth=4)
+    for i, (_, id_degrees) in enumerate(months):
+        month_ids, _, values = link_id_degrees(id_degrees, i)
+        rows = id_index.get_indexer(month_ids)
+        missing += int((rows == -1).sum())
+        raw[i, rows[rows >= 0]] = values[rows >= 0]
+
+    raw.flush()
+    del (raw)
+    print("Degree entries without a compound index:", missing)
+
+    print("\n----- Calculating preferential attachment -----\n")
+    degree_store.cumulate_store(fp, ram_budget)
+
+
+def build_prefix_index(degrees):
+    """ Builds a per-compound cumulative degree (prefix sum) index
+
+    The index has the same sparsity pattern as the monthly degree matrix, but each
+    stored value is the cumulative degree of that compound through that month. The
+    cumulative degree at any month is the last stored value at or before it.
+
+    Args:
+        degrees (scipy csr_matrix): monthly degrees, from build_degree_matrix()
+
+    Returns:
+        scipy csr_matrix: int64 cumulative degrees, stored only where a compound's
+            degree changes
+    """
+    prefix = sparse.csr_matrix(degrees, dtype=np.int64, copy=True)
+    prefix.sum_duplicates()
+
+    #Cumulative sum of all entries, minus the running total before each row starts
+    totals = np.concatenate([[0], np.cumsum(prefix.data, dtype=np.int64)])
+    row_offsets = np.repeat(totals[prefix.indptr[:-1]], np.diff(prefix.indptr))
+    prefix.data = totals[1:] - row_offsets
+
+    return prefix
+
+
+def prefix_keys(prefix):
+    """ Flattens (row, month) positions of a prefix index into sorted search keys
+
+    Args:
+        prefix (scipy csr_matrix): cumulative degree index, from build_prefix_index()
+
+    Returns:
+        numpy array: int64 keys (row * months + month), sorted
+    """
+    rows = np.repeat(np.arange(prefix.shape[0], dtype=np.int64),
+                     np.diff(prefix.indptr))
+    return rows * prefix.shape[1] + prefix.indices
+
 
-    i = 0  #update number (to link id_degree lists with updates)
-    for update in updates:
-        # subprocess.run([
-        #     "rclone",
-        #     "copy",
-        #     "SureChemBL_Patents:Degrees/Months/id_degrees_" + update + ".p",
-        #     "/scratch/jmalloy3/Degrees/Months/",
-        # ])
+def prefix_degrees(prefix, month, keys=None):
+    """ Finds the cumulative degree of every compound through a given month
 
-        #Load id_degree dictionary - attempting through GDrive
-        id_degrees = pickle.load(file=open(
-            "SureChemBL_Patents:Degrees/Months/id_degrees_" + update + ".p",
-            "rb"))
+    Uses a single binary search over all compounds, so the lookup is independent
+    of the number of months in the index.
 
-        # #Load id_degree dictionary
-        # id_degrees = pickle.load(file=open(
-        #     "/scratch/jmalloy3/Degrees/Months/id_degrees_" + update +
-        #     ".p", "rb"))
+    Args:
+        prefix (scipy csr_matrix): cumulative degree index, from build_prefix_index()
+        month (int): month index (inclusive); -1 returns all zeros
+        keys (numpy array): precomputed prefix_keys(prefix), to reuse across calls
 
-        full_id_degrees = link_id_degrees(full_id_degrees, id_degrees, i, bins)
-        i += 1  #increment position
+    Returns:
+        numpy array: int64 cumulative degree of each compound
+    """
+    n, bins = prefix.shape
+    degrees = np.zeros(n, dtype=np.int64)
+    if month < 0:
+        return degrees
+    if keys is None:
+        keys = prefix_keys(prefix)
 
-        # #Remove file from scratch
-        # subprocess.run([
-        #     "rclone", "moveto",
-        #     "/scratch/jmalloy3/Degrees/Months/id_degrees_" + update + ".p",
-        #     "SureChemBL_Patents:Degrees/Months/id_degrees_" + update + ".p",
-        # ])
+    month = min(month, bins - 1)
+    targets = np.arange(n, dtype=np.int64) * bins + month
+    pos = np.searchsorted(keys, targets, side="right") - 1
 
-    #print(list(islice(full_id_degrees.items(), 10)))
+    #Positions before the start of a row mean no degree up to that month
+    found = pos >= prefix.indptr[:-1]
+    degrees[found] = prefix.data[pos[found]]
 
-    full_id_degrees = replace_zeroes(full_id_degrees)
+    return degrees
 
-    #print(list(islice(full_id_degrees.items(), 10)))
 
-    pickle.dump(full_id_degrees,
-                file=open(
-                    "/scratch/jmalloy3/Degrees/full_id_degrees_" + str(start) +
-                    "_" + str(stop) + ".p", "wb"))
+def window_attachment(prefix, a, b, keys=None):
+    """ Finds the preferential attachment index of every compound over a window of months
 
-    pref_attach_dict = pref_attachment_calculation(full_id_degrees)
+    Matches the attachment index of degree_store.cumulate_store() run over months
+    [a, b] only: the mean monthly difference of cumulative degrees is
+    (P[b] - P[a]) / (b - a), where P is the prefix sum of monthly degrees.
 
-    #print(list(islice(pref_attach_dict.items(), 10)))
+    Args:
+        prefix (scipy csr_matrix): cumulative degree index, from build_prefix_index()
+        a (int): first month index of the window
+        b (int): last month index of the window (inclusive)
+        keys (numpy array): precomputed prefix_keys(prefix), to reuse across calls
+
+    Returns:
+        attachments (numpy array): attachment index of each compound (NaN if a == b)
+        window_degrees (numpy array): total degree of each compound within the window
+    """
+    if keys is None:
+        keys = prefix_keys(prefix)
 
-    pickle.dump(pref_attach_dict,
-                file=open(
-                    "/scratch/jmalloy3/pref_attach_dict_" + str(start) + "_" +
-                    str(stop) + ".p", "wb"))
+    before = prefix_degrees(prefix, a - 1, keys)
+    first = prefix_degrees(prefix, a, keys)
+    last = prefix_degrees(prefix, b, keys)
+
+    if b > a:
+        attachments = (last - first) / (b - a)
+    else:
+        attachments = np.full(len(last), np.nan)
+
+    return attachments, last - before
+
+
+def build_cumulative_index(start, stop):
+    """ Builds and saves the cumulative degree index over a full range of years
+
+    Every id_degrees_* file is loaded once; any window within [start, stop] can
+    then be answered from the index with calculate_window_attachment().
+
+    Args:
+        start (int): first year of the index
+        stop (int): last year of the index (inclusive)
+    """
+    print("\n----- Building cumulative degree index -----\n")
+    ids, degrees = load_degree_matrix(build_month_list(start, stop))
+    prefix = build_prefix_index(degrees)
+
+    storage.LocalStorage(storage.SCRATCH).dump(
+        {
+            "ids": ids,
+            "prefix": prefix,
+            "start": start,
+            "stop": stop
+        }, "Degrees/prefix_index_" + str(start) + "_" + str(stop) + ".p")
+
+
+def calculate_window_attachment(index_fp, increments):
+    """ Calculates preferential attachment for many year windows from a cumulative index
+
+    Saves a pref_attach_dict_<start>_<stop>.p and final_degrees_<start>_<stop>.p for
+    every window, containing each compound with a nonzero degree in that window.
+
+    Args:
+        index_fp (string): filepath to a pickled index from build_cumulative_index()
+        increments (list): list of (start, stop) year tuples, e.g. from build_increments()
+    """
+    index = pickle.load(file=open(index_fp, "rb"))
+    scratch = storage.LocalStorage(storage.SCRATCH)
+    ids, prefix = index["ids"], index["prefix"]
+    keys = prefix_keys(prefix)
+
+    for window_start, window_stop in increments:
+        print("\n----- Window", window_start, window_stop, "-----\n")
+        a = (window_start - index["start"]) * 12
+        b = (window_stop - index["start"]) * 12 + 11
+
+        attachments, window_degrees = window_attachment(prefix, a, b, keys)
+        present = window_degrees > 0
+
+        label = str(window_start) + "_" + str(window_stop)
+        scratch.dump(dict(zip(ids[present], attachments[present].tolist())),
+                     "pref_attach_dict_" + label + ".p")
+        scratch.dump(dict(zip(ids[present], window_degrees[present].tolist())),
+                     "Degrees/final_degrees_" + label + ".p")
 
 
 def clear_scratch(start, stop):
@@ -333,37 +512,35 @@ def clear_scratch(start, stop):
     Move: id_degrees (in Degrees/Months) - worked
         : degrees (in Degrees/Months) - worked
         : network_stats (in NetworkStats)
-        : full_id_degrees (in Degrees)
-        : pref_attach_dict (in scratch/jmalloy3)
+        : full_id_degrees store directory (in Degrees)
 
     Delete: G_cpd_XXXX-MM.p, in Graphs/
 
+    All files are moved in a single batched transfer (see storage.py).
+
     """
     fps_months = [
         "Degrees/Months/id_degrees_", "Degrees/Months/degrees_", "Graphs/C_cpd_"
     ]
-    fps_years = [
-        "NetworkStats/stats_", "Degrees/full_id_degrees_",
-        "pref_attach_dict_"
-    ]
+    fps_years = ["NetworkStats/stats_"]
+    label = str(start) + "_" + str(stop)
 
-    updates = build_month_list(start, stop)
-    for update in updates:
-        for f in fps_months:
-            #Move all files to GDrive
-            subprocess.run([
-                "rclone", "moveto", "/scratch/jmalloy3/" + f + update + ".p",
-                "SureChemBL_Patents:" + f + update + ".p"
-            ])
-
-    for f in fps_years:
-        #Move all files to GDrive
-        subprocess.run([
-            "rclone", "moveto",
-            "/scratch/jmalloy3/" + f + str(start) + "_" + str(stop) + ".p",
-            "SureChemBL_Patents:" + f + str(start) + "_" + str(stop) +
-            ".p"
-        ])
+    keys = [f + update + ".p" for update in build_month_list(start, stop)
+            for f in fps_months]
+    keys += [f + label + ".p" for f in fps_years]
+
+    #Degree store directory (see degree_store.py)
+    store_key = "Degrees/full_id_degrees_" + label
+    if os.path.isdir(storage.SCRATCH + store_key):
+        keys += [
+            store_key + "/" + name
+            for name in os.listdir(storage.SCRATCH + store_key)
+        ]
+
+    #Move all files to GDrive
+    storage.RemoteStorage().upload(keys,
+                                   storage.LocalStorage(storage.SCRATCH),
+                                   move=True)
 
 
 def build_increments(start, stop, increment):
@@ -393,12 +570,14 @@ def main():
 
     ## NOTE: building preferential attachement across entire network
 
-    # five_year_increments = build_increments(start, stop, 5)
-    # ten_year_increments = build_increments(start, stop, 10)
-    # #twenty_year_increments = build_increments(start, stop, 20)
-
-    # for inc in five_year_increments + ten_year_increments: # + twenty_year_increments:
-    #     start, stop = inc[0], inc[1]
+    # #Build the cumulative degree index once, then answer every window from it
+    # build_cumulative_index(1962, 2019)
+    # five_year_increments = build_increments(1980, 2019, 5)
+    # ten_year_increments = build_increments(1980, 2019, 10)
+    # twenty_year_increments = build_increments(1980, 2019, 20)
+    # calculate_window_attachment(
+    #     storage.SCRATCH + "Degrees/prefix_index_1962_2019.p",
+    #     five_year_increments + ten_year_increments + twenty_year_increments)
 
     #Calculate basic high-level network stats from SureChemBL updates
     #get_network_stats(start, stop)
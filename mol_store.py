@@ -0,0 +1,141 @@
+""" Persistent store of parsed RDKit molecules
+
+Parsing InChIs with RDKit is repeated by every descriptor run. get_mol() and
+get_mols() parse each molecule once and keep it in a local sqlite database as an
+RDKit binary mol blob, keyed by InChIKey (see assembly_dedup.inchi_key()). Later
+runs rebuild the molecule from the blob, which is much faster than parsing the
+InChI again. InChIs which RDKit cannot parse are recorded too, so later runs
+(including assembly runs, see is_unparseable() and assembly_cache.py) skip them
+immediately.
+
+As with assembly_cache.py, the database uses write-ahead logging so worker
+processes can share it.
+
+"""
+
+import os
+import sqlite3
+from rdkit import Chem
+from rdkit import RDLogger
+from assembly_dedup import inchi_key
+
+RDLogger.DisableLog("rdApp.*")
+
+#Default store location (relative to the working directory, as with Data/)
+DEFAULT_STORE = "Data/mol_store.sqlite"
+
+#Open connections of this process, for each store filepath (and read-only mode)
+_connections = {}
+
+
+def connect(fp=DEFAULT_STORE):
+    """ Opens (once per process) the molecule store, creating it if needed
+
+    Args:
+        fp (string): filepath to the sqlite store
+
+    Returns:
+        sqlite3 connection
+    """
+    key = (os.getpid(), fp)
+    if key not in _connections:
+        os.makedirs(os.path.dirname(fp) or ".", exist_ok=True)
+        conn = sqlite3.connect(fp, timeout=300, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS mols (
+                            inchikey TEXT PRIMARY KEY,
+                            mol BLOB)""")
+        _connections[key] = conn
+    return _connections[key]
+
+
+def parse(inchi):
+    """ Parses an InChI with RDKit
+
+    Returns:
+        rdkit molecule (None if the InChI cannot be parsed)
+    """
+    try:
+        return Chem.MolFromInchi(inchi)
+    except Exception:
+        return None
+
+
+def get_mols(inchis, fp=DEFAULT_STORE, batch_size=500):
+    """ Loads (or parses and stores) the molecules of many InChIs
+
+    Args:
+        inchis (list): compound inchi descriptors
+        fp (string): filepath to the sqlite store
+        batch_size (int): number of keys per database query
+
+    Returns:
+        list: rdkit molecule of each inchi (None if it cannot be parsed)
+    """
+    conn = connect(fp)
+    keys = [inchi_key(inchi) for inchi in inchis]
+
+    #Stored blobs (an empty blob marks a parsing failure)
+    blobs = {}
+    unique = list(dict.fromkeys(keys))
+    for i in range(0, len(unique), batch_size):
+        batch = unique[i:i + batch_size]
+        blobs.update(
+            conn.execute(
+                "SELECT inchikey, mol FROM mols WHERE inchikey IN (" +
+                ",".join("?" * len(batch)) + ")", batch).fetchall())
+
+    #Parse and store any new molecules
+    new = {}
+    for key, inchi in zip(keys, inchis):
+        if key not in blobs and key not in new:
+            mol = parse(inchi)
+            new[key] = mol.ToBinary() if mol is not None else b""
+    if new:
+        conn.executemany("INSERT OR REPLACE INTO mols VALUES (?, ?)",
+                         new.items())
+        blobs.update(new)
+
+    return [Chem.Mol(blobs[key]) if blobs[key] else None for key in keys]
+
+
+def is_unparseable(inchi, fp=DEFAULT_STORE):
+    """ Whether an earlier run recorded that RDKit cannot parse an InChI
+
+    Only reads the store (opened read-only, and not created if it does not exist) -
+    nothing is parsed or written, so it is cheap enough to call before every
+    assembly calculation.
+
+    Args:
+        inchi (string): compound inchi descriptor
+        fp (string): filepath to the sqlite store
+
+    Returns:
+        bool: True if the InChI is stored as a parsing failure
+    """
+    if not os.path.isfile(fp):
+        return False
+
+    key = (os.getpid(), fp, "ro")
+    if key not in _connections:
+        _connections[key] = sqlite3.connect("file:" + fp + "?mode=ro",
+                                            uri=True,
+                                            timeout=300)
+    row = _connections[key].execute("SELECT mol FROM mols WHERE inchikey = ?",
+                                    (inchi_key(inchi),)).fetchone()
+    return row is not None and not row[0]
+
+
+def get_mol(inchi, fp=DEFAULT_STORE):
+    """ Loads (or parses and stores) the molecule of an InChI
+
+    Args:
+        inchi (string): compound inchi descriptor
+        fp (string): filepath to the sqlite store
+
+    Returns:
+        rdkit molecule (None if the InChI cannot be parsed)
+    """
+    return get_mols([inchi], fp)[0]
+
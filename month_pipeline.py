@@ -0,0 +1,177 @@
+""" Background loading and writing for month-by-month loops
+
+Most analyses here follow a "load pickle, compute, dump pickle" pattern for every
+month. prefetch() loads the next few months on a worker pool while the current
+month is being processed, and AsyncWriter writes outputs on a background thread,
+so wall time approaches max(I/O, compute) instead of their sum. Both are bounded,
+so at most a few months are held in memory at once.
+
+"""
+
+import os
+import pickle
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+
+_DONE = object()
+_ERROR = object()
+
+
+def load_pickle(fp):
+    """ Unpickles a file
+
+    Args:
+        fp (string): filepath to a pickle file
+
+    Returns:
+        object: unpickled object
+    """
+    return pickle.load(file=open(fp, "rb"))
+
+
+def load_pickle_if_exists(fp):
+    """ Unpickles a file, for loops where missing months are expected
+
+    Args:
+        fp (string): filepath to a pickle file
+
+    Returns:
+        object: unpickled object (None if the file does not exist)
+    """
+    if not os.path.isfile(fp):
+        return None
+    return load_pickle(fp)
+
+
+def dump_pickle(obj, fp):
+    """ Pickles an object to a file
+
+    Args:
+        obj (object): object to save
+        fp (string): filepath to write
+    """
+    pickle.dump(obj, file=open(fp, "wb"))
+
+
+def prefetch(items, load, depth=2, workers=2, processes=False):
+    """ Iterates over items, loading upcoming items in the background
+
+    The items iterable itself is also consumed in the background, so a generator
+    which transfers files (e.g. get_cpd_network_data.fetch_id_degrees()) overlaps
+    with the loop body too.
+
+    Args:
+        items (iterable): items to load, in order (e.g. months or filepaths)
+        load (function): loads a single item (must be picklable if processes=True)
+        depth (int): number of items loaded (or loading) ahead of the item being
+            processed - at most depth + 1 items are held at once
+        workers (int): number of concurrent loads
+        processes (bool): load in worker processes instead of threads (for
+            CPU-heavy decoding; results are pickled back to the main process)
+
+    Yields:
+        tuple: (item, loaded value), in the order of items
+    """
+    pool = (ProcessPoolExecutor if processes else ThreadPoolExecutor)(workers)
+    pending = queue.Queue()
+    stop = threading.Event()
+    #One slot per item loaded or being processed, taken before the load starts
+    slots = threading.Semaphore(max(1, depth) + 1)
+
+    def produce():
+        try:
+            for item in items:
+                while not slots.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                if stop.is_set():
+                    return
+                pending.put((item, pool.submit(load, item)))
+        except BaseException as e:
+            pending.put((_ERROR, e))
+            return
+        pending.put((_DONE, None))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            item, future = pending.get()
+            if item is _DONE:
+                break
+            if item is _ERROR:
+                raise future
+            yield item, future.result()
+            #Free the slot once the loop body is done with the item
+            del (future)
+            slots.release()
+    finally:
+        #Stop the producer if the loop ended early
+        stop.set()
+        producer.join()
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+class AsyncWriter:
+    """ Runs write calls on background threads, through a bounded queue
+
+    submit() blocks once maxsize writes are waiting, so outputs never pile up in
+    memory. Errors from a write are raised again on the next submit() or close().
+
+    Usage:
+        with AsyncWriter() as writer:
+            for month in months:
+                writer.submit(dump_pickle, data, fp)
+    """
+
+    def __init__(self, maxsize=4, workers=1):
+        """
+        Args:
+            maxsize (int): number of writes that may wait in the queue
+            workers (int): number of writer threads
+        """
+        self.queue = queue.Queue(maxsize=max(1, maxsize))
+        self.errors = []
+        self.threads = [
+            threading.Thread(target=self._run, daemon=True)
+            for _ in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            if task is _DONE:
+                return
+            write, args, kwargs = task
+            try:
+                write(*args, **kwargs)
+            except BaseException as e:
+                self.errors.append(e)
+
+    def _raise(self):
+        if self.errors:
+            raise self.errors.pop(0)
+
+    def submit(self, write, *args, **kwargs):
+        """ Queues write(*args, **kwargs) to run in the background """
+        self._raise()
+        self.queue.put((write, args, kwargs))
+
+    def close(self):
+        """ Waits for all queued writes to finish """
+        for _ in self.threads:
+            self.queue.put(_DONE)
+        for thread in self.threads:
+            thread.join()
+        self._raise()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,196 @@
+""" Storage backends for SureChemBL data files
+
+Data files are addressed by a relative key (e.g. "Degrees/Months/id_degrees_1980-01.p")
+instead of hard-coded /scratch, G: drive or rclone paths. LocalStorage reads and
+writes a directory directly. RemoteStorage wraps an rclone remote (e.g.
+"SureChemBL_Patents:") - or any local directory standing in for one - and keeps a
+size-bounded, least-recently-used disk cache, so each monthly file is only
+transferred once and is reused across runs.
+
+"""
+
+import os
+import pickle
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+#Locations used on Agave
+SCRATCH = "/scratch/jmalloy3/"
+REMOTE = "SureChemBL_Patents:"
+
+#Default size of the local cache of remote files (in bytes)
+DEFAULT_CACHE_BYTES = 200 * 1024**3
+
+
+class LocalStorage:
+    """ Files stored in a directory on the local filesystem """
+
+    def __init__(self, root):
+        """
+        Args:
+            root (string): directory holding all keys
+        """
+        self.root = root
+
+    def path(self, key):
+        """ Local filepath of a key, creating its parent directory if needed """
+        fp = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(fp) or ".", exist_ok=True)
+        return fp
+
+    def exists(self, key):
+        return os.path.isfile(os.path.join(self.root, key))
+
+    def fetch(self, keys):
+        """ Local filepaths of a list of keys (files are already local) """
+        return [self.path(key) for key in keys]
+
+    def load(self, key):
+        """ Unpickles the object stored under key """
+        return pickle.load(file=open(self.fetch([key])[0], "rb"))
+
+    def dump(self, obj, key):
+        """ Pickles obj to key """
+        pickle.dump(obj, file=open(self.path(key), "wb"))
+
+    def remove(self, key):
+        if self.exists(key):
+            os.remove(os.path.join(self.root, key))
+
+
+class RemoteStorage:
+    """ Files stored on an rclone remote (or a stand-in directory), with a local LRU cache """
+
+    def __init__(self,
+                 remote=REMOTE,
+                 cache_dir=SCRATCH + "Cache/",
+                 cache_bytes=DEFAULT_CACHE_BYTES,
+                 transfers=8):
+        """
+        Args:
+            remote (string): rclone remote (e.g. "SureChemBL_Patents:") or a local
+                directory used in its place (e.g. a G: drive mount, or a test folder)
+            cache_dir (string): local directory for cached copies of remote files
+            cache_bytes (int): maximum total size of the cache
+            transfers (int): number of concurrent transfers
+        """
+        self.remote = remote
+        self.is_directory = os.path.isdir(remote)
+        self.cache = LocalStorage(cache_dir)
+        self.cache_bytes = cache_bytes
+        self.transfers = transfers
+
+    def exists(self, key):
+        if self.is_directory:
+            return os.path.isfile(os.path.join(self.remote, key))
+        result = subprocess.run(["rclone", "lsf", self.remote + key],
+                                capture_output=True,
+                                text=True)
+        return result.returncode == 0 and result.stdout.strip() != ""
+
+    def fetch(self, keys):
+        """ Copies any uncached keys from the remote in one batch
+
+        Args:
+            keys (list): keys to fetch
+
+        Returns:
+            list: local (cached) filepath of each key
+        """
+        missing = [key for key in dict.fromkeys(keys) if not self.cache.exists(key)]
+        if missing:
+            self._transfer(missing, self.remote, self.cache.root)
+
+        paths = []
+        for key in keys:
+            fp = self.cache.path(key)
+            if os.path.isfile(fp):
+                os.utime(fp)  #mark as recently used
+            paths.append(fp)
+
+        self.evict(protect=keys)
+
+        return paths
+
+    def load(self, key):
+        """ Unpickles the object stored under key (through the cache) """
+        return pickle.load(file=open(self.fetch([key])[0], "rb"))
+
+    def upload(self, keys, local, move=False):
+        """ Copies (or moves) keys from local storage to the remote in one batch
+
+        Args:
+            keys (list): keys to upload
+            local (LocalStorage): storage holding the files
+            move (bool): remove the local files after a successful upload
+        """
+        keys = [key for key in keys if local.exists(key)]
+        if not keys:
+            return
+        self._transfer(keys, local.root, self.remote, move)
+
+    def evict(self, protect=()):
+        """ Removes least-recently-used cache files until the cache fits in cache_bytes
+
+        Args:
+            protect (list): keys which must stay cached (e.g. the current batch)
+        """
+        protected = {os.path.normpath(self.cache.path(key)) for key in protect}
+        files = []
+        total = 0
+        for root, _, names in os.walk(self.cache.root):
+            for name in names:
+                fp = os.path.normpath(os.path.join(root, name))
+                stat = os.stat(fp)
+                total += stat.st_size
+                if fp not in protected:
+                    files.append((stat.st_mtime, stat.st_size, fp))
+
+        for _, size, fp in sorted(files):
+            if total <= self.cache_bytes:
+                break
+            os.remove(fp)
+            total -= size
+
+    def _transfer(self, keys, source, dest, move=False):
+        """ Transfers keys from source to dest with self.transfers concurrent copies
+
+        Args:
+            keys (list): keys (relative paths) to transfer
+            source (string): rclone remote or local directory
+            dest (string): rclone remote or local directory
+            move (bool): remove files from source after transferring
+        """
+        if self.is_directory:
+            copy = shutil.move if move else shutil.copyfile
+
+            def transfer(key):
+                src = os.path.join(source, key)
+                dst = os.path.join(dest, key)
+                if not os.path.isfile(src):
+                    return
+                os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+                #Copy to a temporary name first so partial files are never read
+                tmp = dst + ".part"
+                copy(src, tmp)
+                os.replace(tmp, dst)
+
+            with ThreadPoolExecutor(self.transfers) as pool:
+                list(pool.map(transfer, keys))
+        else:
+            with tempfile.NamedTemporaryFile("w", suffix=".txt",
+                                             delete=False) as f:
+                f.write("\n".join(keys) + "\n")
+            #A failed transfer raises CalledProcessError, so callers never
+            # delete local data which was not copied
+            try:
+                subprocess.run([
+                    "rclone", "move" if move else "copy", source, dest,
+                    "--files-from", f.name, "--transfers",
+                    str(self.transfers)
+                ],
+                               check=True)
+            finally:
+                os.remove(f.name)